@@ -0,0 +1,93 @@
+"""
+Cold-start import time check of the thirsty CLI
+
+The CLI module is imported in fresh interpreters with -X importtime, and
+the check fails when the best cumulative import time is over budget, or
+when one of the heavy dependencies only needed by some stages (maps, GPX
+output, HTTP) is imported at startup.
+
+    python benchmarks/importtime.py --budget 400
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+import rich.console
+import rich.table
+
+console = rich.console.Console()
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules imported at startup by default
+DEFAULT_MODULE = "thirsty.cli"
+
+# Dependencies only imported by the stages using them
+LAZY_MODULES = ["folium", "branca", "jinja2", "gpxpy", "requests", "aiohttp", "osmium"]
+
+
+def import_times(module):
+    """
+    Return the cumulative import time of each module imported by a fresh interpreter importing module (in µs)
+    """
+
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, cwd=ROOT, check=True)
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the cold-start import time of the thirsty CLI.")
+
+    parser.add_argument("--module", default=DEFAULT_MODULE,
+                        help=f"module imported at startup (default: {DEFAULT_MODULE})")
+
+    parser.add_argument("--budget", type=float, default=400,
+                        help="largest cumulative import time of the module (in milliseconds, default: 400)")
+
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="number of fresh interpreters, the fastest one is kept")
+
+    parser.add_argument("--top", type=int, default=10,
+                        help="number of slowest imports reported")
+
+    args = parser.parse_args()
+
+    runs = [import_times(args.module) for _ in range(args.repeat)]
+    times = min(runs, key=lambda times: times[args.module])
+    total_ms = times[args.module] / 1000
+
+    table = rich.table.Table(title=f"Slowest imports of {args.module}")
+    table.add_column("Module")
+    table.add_column("Cumulative (ms)", justify="right")
+    for name, cumulative in sorted(times.items(), key=lambda item: -item[1])[:args.top]:
+        table.add_row(name, f"{cumulative / 1000:.1f}")
+    console.print(table)
+
+    failed = False
+
+    lazy = sorted({name.split(".")[0] for name in times} & set(LAZY_MODULES))
+    if lazy:
+        console.print(f"❌ Imported at startup: {', '.join(lazy)}")
+        failed = True
+
+    if total_ms > args.budget:
+        console.print(f"❌ Importing {args.module} took {total_ms:.0f} ms, over the {args.budget:.0f} ms budget")
+        failed = True
+    else:
+        console.print(f"✅ Importing {args.module} took {total_ms:.0f} ms ({args.budget:.0f} ms budget)")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
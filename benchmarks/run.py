@@ -0,0 +1,305 @@
+"""
+Benchmarks of the thirsty pipeline on synthetic traces
+
+Every stage is timed on traces of increasing sizes, then run once more
+under tracemalloc to record its peak memory. Overpass is never queried:
+the POIs are either synthetic or loaded from a recorded response, and the
+end-to-end CLI run reads them from a pre-filled cache in offline mode.
+
+Results are written to benchmarks/results/<date>-<revision>.json. Timings
+depend on the machine, so no baseline is committed: compare against the
+results of a previous run on the same machine, e.g. of the main branch.
+
+    python benchmarks/run.py --points 10000 100000 -o main.json
+    python benchmarks/run.py --points 10000 100000 --compare main.json
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import gpxpy
+import gpxpy.gpx
+import rich.console
+import rich.table
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synthetic  # noqa: E402
+
+import thirsty.cache  # noqa: E402
+import thirsty.cli  # noqa: E402
+import thirsty.core  # noqa: E402
+import thirsty.track  # noqa: E402
+import thirsty.writer  # noqa: E402
+
+console = rich.console.Console()
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# Arguments selecting every POI type in the end-to-end run
+ALL_POI_ARGUMENTS = [
+    *(f"-w={poi_type}" for poi_type in thirsty.core.WATER_AMENITIES),
+    "-t",
+    *(f"-r={poi_type}" for poi_type in thirsty.core.REPAIR_AMENITIES),
+    *(f"-f={poi_type}" for poi_type in thirsty.core.FOOD_AMENITIES),
+]
+
+
+def write_gpx(path, pois):
+    """
+    Write the GPX document at path with POIs added as waypoints, to a discarded output
+    """
+
+    with open(path, "rb") as source:
+        thirsty.writer.write_gpx(source, io.StringIO(), pois)
+
+
+def measure(function, repeat):
+    """
+    Return the best time of repeat calls of function, and its peak traced memory
+    """
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    # Tracing slows everything down, so memory is measured on a separate run
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return min(times), peak
+
+
+def run_cli(path, elements, workdir):
+    """
+    Run the whole CLI on a trace, with Overpass answered from a pre-filled cache
+    """
+
+    cache_dir = os.path.join(workdir, "cache")
+    output = os.path.join(workdir, "output.gpx")
+
+    track = thirsty.track.read_track(open(path, "rb"))  # noqa: SIM115
+    query = thirsty.core.build_overpass_query(thirsty.core.get_bounds(track),
+                                              list(thirsty.core.WATER_AMENITIES),
+                                              list(thirsty.core.TOILET_AMENITIES),
+                                              list(thirsty.core.REPAIR_AMENITIES),
+                                              list(thirsty.core.FOOD_AMENITIES))
+    thirsty.cache.Cache(cache_dir).set(query, elements)
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            thirsty.cli.main([path, output, *ALL_POI_ARGUMENTS, "--cache-dir", cache_dir, "--offline"])
+
+    return run
+
+
+def benchmark_size(points, args, workdir):
+    """
+    Return the results of every stage on a synthetic trace of the given number of points
+    """
+
+    path = os.path.join(workdir, f"trace-{points}.gpx")
+    with open(path, "w") as f:
+        synthetic.write_track(f, points, segments=args.segments, step_m=args.step, seed=args.seed)
+
+    track = thirsty.track.read_track(open(path, "rb"))  # noqa: SIM115
+
+    if args.elements:
+        with open(args.elements) as f:
+            elements = json.load(f)
+        elements = elements.get("elements", elements) if isinstance(elements, dict) else elements
+    else:
+        count = int(args.density * points * args.step / 1000)
+        elements = synthetic.generate_elements(track, count, spread_m=args.spread, seed=args.seed)
+
+    pois = thirsty.core.filter_pois_near_track(track, elements, max_distance_m=args.distance, progress=False)
+    xml = gpxpy.parse(open(path)).to_xml()  # noqa: SIM115
+
+    stages = {
+        "read_track": (lambda: thirsty.track.read_track(open(path, "rb")), points),  # noqa: SIM115
+        "get_bounds": (lambda: thirsty.core.get_bounds(track), points),
+        "filter_pois_near_track": (lambda: thirsty.core.filter_pois_near_track(
+            track, elements, max_distance_m=args.distance, progress=False), len(elements)),
+        "filter_pois_near_track_parallel": (lambda: thirsty.core.filter_pois_near_track(
+            track, elements, max_distance_m=args.distance, progress=False, jobs=args.jobs), len(elements)),
+        "add_waypoints_to_gpx": (lambda: thirsty.core.add_waypoints_to_gpx(gpxpy.gpx.GPX(), pois), len(pois)),
+        "display_gpx_on_map": (lambda: thirsty.core.display_gpx_on_map(track, pois).get_root().render(), points),
+        "display_gpx_on_map_fast": (lambda: thirsty.core.display_gpx_on_map(
+            track, pois, fast=True).get_root().render(), points),
+        "sanitize_gpx_text": (lambda: thirsty.core.sanitize_gpx_text(xml), len(xml)),
+        "write_gpx": (lambda: write_gpx(path, pois), points),
+        "cli": (run_cli(path, elements, workdir), points),
+    }
+
+    # Fewer POIs than a batch are filtered serially, whatever the jobs
+    if args.jobs <= 1 or len(elements) <= thirsty.core.FILTER_BATCH_SIZE:
+        console.print(f"Skipping filter_pois_near_track_parallel ({points} points): {len(elements)} POIs and "
+                      f"{args.jobs} jobs are filtered serially, it needs more than "
+                      f"{thirsty.core.FILTER_BATCH_SIZE} POIs (see --density) and 2 jobs")
+        del stages["filter_pois_near_track_parallel"]
+
+    results = []
+    for name, (function, items) in stages.items():
+        if name in args.skip:
+            continue
+        seconds, peak = measure(function, args.repeat)
+        results.append({
+            "stage": name,
+            "points": points,
+            "pois": len(elements),
+            "seconds": seconds,
+            "throughput": items / seconds if seconds else None,
+            "peak_mib": peak / 2**20,
+        })
+        console.print(f"{name} ({points} points): {seconds:.3f}s, {peak / 2**20:.1f} MiB")
+
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the ratio of each result to the baseline, and return the number of regressions
+    """
+
+    reference = {(result["stage"], result["points"]): result for result in baseline["results"]}
+
+    table = rich.table.Table(title=f"Compared to {baseline['meta'].get('revision')}")
+    table.add_column("Stage")
+    table.add_column("Points", justify="right")
+    table.add_column("Time", justify="right")
+    table.add_column("Memory", justify="right")
+
+    regressions = 0
+    for result in results:
+        before = reference.get((result["stage"], result["points"]))
+        if before is None:
+            continue
+
+        cells = []
+        for key in ("seconds", "peak_mib"):
+            ratio = result[key] / before[key] if before[key] else 1
+            if ratio > 1 + threshold:
+                regressions += 1
+                cells.append(f"[red]x{ratio:.2f}[/red]")
+            elif ratio < 1 - threshold:
+                cells.append(f"[green]x{ratio:.2f}[/green]")
+            else:
+                cells.append(f"x{ratio:.2f}")
+
+        table.add_row(result["stage"], str(result["points"]), *cells)
+
+    console.print(table)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the thirsty pipeline on synthetic traces.")
+
+    parser.add_argument("--points", type=int, nargs="+", default=[10000, 100000],
+                        help="number of points of the synthetic traces (default: 10000 100000)")
+
+    parser.add_argument("--segments", type=int, default=1,
+                        help="number of track segments of the synthetic traces")
+
+    parser.add_argument("--step", type=float, default=10,
+                        help="distance between consecutive track points (in meters)")
+
+    parser.add_argument("--density", type=float, default=20,
+                        help="number of synthetic POIs per kilometer of trace")
+
+    parser.add_argument("--spread", type=float, default=500,
+                        help="largest distance between synthetic POIs and the trace (in meters)")
+
+    parser.add_argument("--elements", default=None,
+                        help="recorded Overpass JSON response used instead of synthetic POIs")
+
+    parser.add_argument("-d", "--distance", type=float, default=100,
+                        help="search distance around trace (in meters)")
+
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="number of processes of the parallel filtering stage, skipped with fewer POIs than "
+                             f"a batch ({thirsty.core.FILTER_BATCH_SIZE}) or 1 job (default: number of CPUs)")
+
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of timed runs of each stage, the best one is kept")
+
+    parser.add_argument("--skip", action="append", default=[],
+                        help="stage to skip (can be repeated)")
+
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the synthetic data")
+
+    parser.add_argument("-o", "--output", default=None,
+                        help=f"results JSON file (default: {RESULTS_DIR}/<date>-<revision>.json)")
+
+    parser.add_argument("--compare", default=None,
+                        help="results JSON file to compare against")
+
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative slowdown or memory growth reported as a regression")
+
+    parser.add_argument("--fail-on-regression", action="store_true",
+                        help="exit with an error status when a regression is found")
+
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for points in args.points:
+            results.extend(benchmark_size(points, args, workdir))
+
+    revision = git_revision()
+    report = {
+        "meta": {
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "revision": revision,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "options": {key: value for key, value in vars(args).items()
+                        if key not in ("output", "compare", "fail_on_regression")},
+        },
+        "results": results,
+    }
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{datetime.date.today().isoformat()}-{revision or 'unknown'}.json")
+
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    console.print(f"✅ Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
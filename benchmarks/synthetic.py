@@ -0,0 +1,78 @@
+"""
+Synthetic GPX traces and Overpass responses for the benchmarks
+"""
+
+import math
+import random
+
+import thirsty.core
+
+METERS_PER_DEGREE = math.radians(1) * 6371000
+
+# Tags of the synthetic POIs, one per amenity of every category
+POI_TAGS = [dict(thirsty.core.parse_tag_filter(tag_filter))
+            for _, amenities, _ in thirsty.core.POI_CATEGORIES
+            for tag_filter in amenities.values()]
+
+# Names given to some POIs, including characters to escape in XML
+POI_NAMES = ["Fontaine", "Chez Paul & Fils", "Le <Relais>", "Café de l'Église", "Boulangerie \"Au Pain\""]
+
+
+def write_track(f, points, segments=1, step_m=10, start=(45.0, 5.0), seed=0):
+    """
+    Write a random-walk GPX trace to a text file object
+
+    The trace has the given number of points, split in segments, with
+    step_m meters between consecutive points.
+    """
+
+    rng = random.Random(seed)
+    lat, lon = start
+    heading = rng.uniform(0, 2 * math.pi)
+
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<gpx version="1.1" creator="thirsty benchmarks" xmlns="http://www.topografix.com/GPX/1/1">\n'
+            ' <metadata>\n  <name>Synthetic trace</name>\n </metadata>\n'
+            ' <trk>\n  <name>Synthetic trace</name>\n')
+
+    per_segment = math.ceil(points / segments)
+    for first in range(0, points, per_segment):
+        f.write("  <trkseg>\n")
+        for i in range(first, min(first + per_segment, points)):
+            heading += rng.gauss(0, 0.2)
+            lat += step_m * math.cos(heading) / METERS_PER_DEGREE
+            lon += step_m * math.sin(heading) / (METERS_PER_DEGREE * math.cos(math.radians(lat)))
+            f.write(f'   <trkpt lat="{lat:.7f}" lon="{lon:.7f}">\n'
+                    f'    <ele>{100 + 50 * math.sin(i / 500):.1f}</ele>\n'
+                    '   </trkpt>\n')
+        f.write("  </trkseg>\n")
+
+    f.write(" </trk>\n</gpx>\n")
+
+
+def generate_elements(track, count, spread_m=500, seed=0):
+    """
+    Return a synthetic Overpass response: count POI nodes scattered around a Track
+
+    Each POI is placed at a random track point, moved by up to spread_m
+    meters in both directions. The density along the trace is thus count
+    divided by the trace length, and the share of POIs kept by the filter
+    decreases as spread_m grows.
+    """
+
+    rng = random.Random(seed)
+    elements = []
+
+    for i in range(count):
+        point = rng.randrange(len(track))
+        lat = float(track.lat[point]) + rng.uniform(-spread_m, spread_m) / METERS_PER_DEGREE
+        lon = float(track.lon[point]) + rng.uniform(-spread_m, spread_m) / (
+            METERS_PER_DEGREE * math.cos(math.radians(lat)))
+
+        tags = dict(rng.choice(POI_TAGS))
+        if rng.random() < 0.5:
+            tags["name"] = rng.choice(POI_NAMES)
+
+        elements.append({"type": "node", "id": i + 1, "lat": lat, "lon": lon, "tags": tags})
+
+    return elements
@@ -8,10 +8,15 @@ setup(
         "pre-commit==4.2.0",
         "commitizen==4.6.0",
         "gpxpy==1.6.2",
+        "numpy==2.2.5",
         "requests==2.32.3",
         "rich==14.0.0",
         "folium==0.19.5",
     ],
+    extras_require={
+        "index": ["osmium==4.3.1"],
+        "serve": ["aiohttp==3.14.5"],
+    },
     entry_points={
         "console_scripts": [
             "thirsty=thirsty.cli:main"
@@ -23,5 +28,5 @@ setup(
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: GNU General Public License v3 or later (GPLv3+)",
     ],
-    python_requires=">=3.7",
+    python_requires=">=3.10",
 )
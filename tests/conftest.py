@@ -0,0 +1,59 @@
+"""
+Local stub of the Overpass API, shared by the tests
+"""
+
+import http.server
+import json
+import threading
+
+import pytest
+
+
+class StubOverpass:
+    """
+    Overpass instance answering queries with scripted (status, headers, body) responses
+
+    The last response is repeated once the others are used up.
+    """
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.queries = []
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                stub.queries.append(self.rfile.read(int(self.headers["Content-Length"])).decode())
+                status, headers, body = stub.responses.pop(0) if len(stub.responses) > 1 else stub.responses[0]
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/api/interpreter"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub():
+    stubs = []
+
+    def start(*responses):
+        stubs.append(StubOverpass(responses))
+        return stubs[-1]
+
+    yield start
+
+    for server in stubs:
+        server.close()
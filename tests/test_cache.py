@@ -0,0 +1,62 @@
+"""
+Expiry of the cache entries
+"""
+
+import os
+import time
+
+import thirsty.cache
+
+
+def test_memory_cache_keeps_backend_write_time(tmp_path):
+    backend = thirsty.cache.Cache(str(tmp_path))
+    backend.set("query", [1])
+    written = time.time() - 60
+    os.utime(backend.path("query"), (written, written))
+
+    cache = thirsty.cache.MemoryCache(backend)
+
+    assert cache.get("query", ttl=120) == [1]
+    assert cache._entries["query"][0] == written
+    assert cache.get("query", ttl=30) is None
+
+
+def test_get_entry_returns_write_time(tmp_path):
+    cache = thirsty.cache.Cache(str(tmp_path))
+    before = time.time()
+    cache.set("query", {"elements": []})
+
+    stored, value = cache.get_entry("query")
+
+    assert value == {"elements": []}
+    assert before - 1 <= stored <= time.time()
+    assert cache.get("missing") is None
+
+
+def test_entry_evicted_during_get(tmp_path, monkeypatch):
+    cache = thirsty.cache.Cache(str(tmp_path))
+    cache.set("query", [1])
+
+    def evicted(path, times):
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr(os, "utime", evicted)
+
+    assert cache.get("query") == [1]
+
+
+def test_directory_scanned_once_under_max_size(tmp_path, monkeypatch):
+    scans = []
+    evict_files = thirsty.cache.evict_files
+    monkeypatch.setattr(thirsty.cache, "evict_files", lambda *args: scans.append(args) or evict_files(*args))
+    cache = thirsty.cache.Cache(str(tmp_path), max_size=4096)
+
+    for i in range(5):
+        cache.set(f"query {i}", [i])
+    assert len(scans) == 1
+
+    for i in range(50):
+        cache.set(f"large {i}", [str(j) * 10 for j in range(i * 10)])
+    entries = list(tmp_path.iterdir())
+    assert sum(entry.stat().st_size for entry in entries) <= 4096
+    assert 1 < len(scans) < 50
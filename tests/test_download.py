@@ -0,0 +1,78 @@
+"""
+Downloads of GPX traces by URL, revalidated and resumed with the download cache
+"""
+
+import http.server
+import os
+import threading
+
+import pytest
+import requests
+
+import thirsty.cache
+import thirsty.core
+
+DOCUMENT = b'<gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1"></gpx>'
+
+
+@pytest.fixture
+def server():
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/error.gpx":
+                self.send_response(500)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            elif self.headers.get("If-None-Match") == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+            else:
+                self.send_response(200)
+                self.send_header("ETag", '"v1"')
+                self.send_header("Content-Length", str(len(DOCUMENT)))
+                self.end_headers()
+                self.wfile.write(DOCUMENT)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def partial_files(directory):
+    return [name for name in os.listdir(directory) if ".part" in name]
+
+
+def test_revalidation_leaves_no_partial_download(server, tmp_path):
+    cache = thirsty.cache.DownloadCache(str(tmp_path))
+
+    for _ in range(2):
+        with thirsty.core.download_gpx(f"{server}/trace.gpx", cache=cache) as f:
+            assert f.read() == DOCUMENT
+        assert partial_files(tmp_path) == []
+
+
+def test_failed_download_leaves_no_partial_download(server, tmp_path):
+    cache = thirsty.cache.DownloadCache(str(tmp_path))
+
+    with pytest.raises(requests.HTTPError):
+        thirsty.core.download_gpx(f"{server}/error.gpx", cache=cache)
+    assert partial_files(tmp_path) == []
+
+
+def test_partial_downloads_are_evicted(server, tmp_path):
+    cache = thirsty.cache.DownloadCache(str(tmp_path), max_size=len(DOCUMENT) * 2)
+    part = cache.path("http://example.com/stale.gpx", cache.PART_SUFFIX)
+    with open(part, "wb") as f:
+        f.write(b"x" * len(DOCUMENT) * 2)
+    cache.set_partial_headers("http://example.com/stale.gpx", {"ETag": '"old"'})
+    os.utime(part, (0, 0))
+
+    thirsty.core.download_gpx(f"{server}/trace.gpx", cache=cache).close()
+
+    assert partial_files(tmp_path) == []
+    assert cache.get(f"{server}/trace.gpx") is not None
@@ -0,0 +1,172 @@
+"""
+Distances between POIs and the track, against a brute-force measure over every segment
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+import thirsty.core
+import thirsty.geo
+import thirsty.track
+
+EXAMPLE = os.path.join(os.path.dirname(__file__), os.pardir, "examples", "test.gpx")
+
+
+@pytest.fixture(scope="module")
+def track():
+    with open(EXAMPLE, "rb") as f:
+        track = thirsty.track.read_track(f)
+    track.source = None
+    return track
+
+
+def brute_force(segments, lat, lon):
+    """
+    Return the distance of each point to the closest segment of the track, and the along-track distance of the
+    first closest one, measuring every segment
+    """
+
+    starts, ends = [], []
+    for segment in segments:
+        vectors = thirsty.geo.to_unit_vectors(segment[:, 0], segment[:, 1])
+        starts.append(vectors if len(vectors) == 1 else vectors[:-1])
+        ends.append(vectors if len(vectors) == 1 else vectors[1:])
+    starts, ends = np.concatenate(starts), np.concatenate(ends)
+    lengths = thirsty.geo.arc_length(starts, ends)
+    positions = np.cumsum(lengths) - lengths
+
+    distances, along = [], []
+    for point in thirsty.geo.to_unit_vectors(lat, lon):
+        measured, fractions = thirsty.geo.segment_projection(np.tile(point, (len(starts), 1)), starts, ends)
+        closest = np.argmin(measured)
+        distances.append(measured[closest])
+        along.append(positions[closest] + fractions[closest] * lengths[closest])
+    return np.array(distances), np.array(along)
+
+
+def random_pois(track, count, margin=0.01, seed=0):
+    rng = np.random.default_rng(seed)
+    lat = rng.uniform(track.lat.min() - margin, track.lat.max() + margin, count)
+    lon = rng.uniform(track.lon.min() - margin, track.lon.max() + margin, count)
+    tags = [{"amenity": "drinking_water"}, {"amenity": "toilets"}]
+    return [{"type": "node", "id": i, "lat": float(la), "lon": float(lo), "tags": tags[i % 2]}
+            for i, (la, lo) in enumerate(zip(lat, lon))]
+
+
+def check_locate(segments, lat, lon, radius_m, **kwargs):
+    index = thirsty.geo.TrackIndex(segments, radius_m)
+    distances, along = index.locate(thirsty.geo.to_unit_vectors(lat, lon), **kwargs)
+    expected_distances, expected_along = brute_force(segments, lat, lon)
+
+    near = expected_distances < radius_m
+    assert near.any()
+    np.testing.assert_allclose(distances[near], expected_distances[near], rtol=1e-12)
+    np.testing.assert_allclose(along[near], expected_along[near], rtol=1e-9, atol=1e-6)
+    # Beyond the radius, only some segments are measured
+    assert (distances[~near] >= radius_m).all()
+    assert (distances[~near] >= expected_distances[~near] * (1 - 1e-12)).all()
+    return distances, along
+
+
+def test_filter_matches_brute_force(track):
+    pois = random_pois(track, 1500)
+    type_distances = {"TOILET": 60}
+
+    kept = thirsty.core.filter_pois_near_track(track, pois, max_distance_m=150, type_distances=type_distances,
+                                               progress=False)
+
+    lat, lon = np.array([[poi["lat"], poi["lon"]] for poi in pois]).T
+    distances, along = brute_force(track.segments, lat, lon)
+    radii = np.array([type_distances.get(thirsty.core.classify_poi(poi).type, 150) for poi in pois])
+    expected = np.flatnonzero(distances < radii)
+
+    assert [poi.id for poi in kept] == expected.tolist()
+    np.testing.assert_allclose([poi.km for poi in kept], along[expected] / 1000, rtol=1e-9, atol=1e-9)
+
+
+def test_locate_matches_brute_force(track):
+    pois = random_pois(track, 1000, margin=0.002, seed=1)
+    lat, lon = np.array([[poi["lat"], poi["lon"]] for poi in pois]).T
+
+    check_locate(track.segments, lat, lon, 200)
+
+
+def test_multiple_segments(track):
+    segments = [track.segments[0][:60], track.segments[0][60:61], track.segments[0][61:]]
+    pois = random_pois(track, 500, margin=0.002, seed=2)
+    lat, lon = np.array([[poi["lat"], poi["lon"]] for poi in pois]).T
+
+    check_locate(segments, lat, lon, 200)
+
+
+def test_pois_near_cell_boundaries(track):
+    radius_m = 300
+    index = thirsty.geo.TrackIndex(track.segments, radius_m)
+    rng = np.random.default_rng(3)
+    vectors = thirsty.geo.to_unit_vectors(track.lat, track.lon)
+
+    # Points snapped to the planes between grid cells, along each axis
+    snapped = []
+    for axis in range(3):
+        points = vectors + rng.normal(scale=index.cell_size / 2, size=vectors.shape)
+        points[:, axis] = np.round(points[:, axis] / index.cell_size) * index.cell_size
+        snapped.append(points)
+    # Points just within the radius of the track points, in every direction
+    angles = rng.uniform(0, 2 * np.pi, len(vectors))
+    ring = np.degrees(0.999 * radius_m / thirsty.geo.EARTH_RADIUS)
+    ring_lat = track.lat + ring * np.sin(angles)
+    ring_lon = track.lon + ring * np.cos(angles) / np.cos(np.radians(track.lat))
+
+    points = np.concatenate(snapped)
+    points /= np.linalg.norm(points, axis=1)[:, None]
+    lat = np.concatenate((np.degrees(np.arcsin(points[:, 2])), ring_lat))
+    lon = np.concatenate((np.degrees(np.arctan2(points[:, 1], points[:, 0])), ring_lon))
+
+    distances, _ = check_locate(track.segments, lat, lon, radius_m)
+    assert (distances[len(points):] < radius_m).all()
+
+
+def test_single_point_track():
+    track = thirsty.track.Track.from_segments([np.array([[43.66, 7.16]])])
+    pois = [{"type": "node", "id": 1, "lat": 43.6604, "lon": 7.16, "tags": {"amenity": "drinking_water"}},
+            {"type": "node", "id": 2, "lat": 43.6615, "lon": 7.16, "tags": {"amenity": "drinking_water"}}]
+
+    kept = thirsty.core.filter_pois_near_track(track, pois, max_distance_m=100, progress=False)
+
+    assert [(poi.id, poi.km) for poi in kept] == [(1, 0.0)]
+    distances, _ = thirsty.geo.TrackIndex(track.segments, 100).locate(thirsty.geo.to_unit_vectors(43.6604, 7.16)[None])
+    assert distances[0] == pytest.approx(thirsty.core.haversine(43.66, 7.16, 43.6604, 7.16), rel=1e-9)
+
+
+def test_parallel_filter_matches_serial(track):
+    pois = random_pois(track, thirsty.core.FILTER_BATCH_SIZE + 1000, seed=4)
+
+    serial = thirsty.core.filter_pois_near_track(track, pois, max_distance_m=150, progress=False)
+    parallel = thirsty.core.filter_pois_near_track(track, pois, max_distance_m=150, progress=False, jobs=2)
+
+    assert serial
+    assert parallel == serial
+
+
+def test_large_radius_stays_under_pair_budget(track, monkeypatch):
+    pois = random_pois(track, 300, seed=5)
+    lat, lon = np.array([[poi["lat"], poi["lon"]] for poi in pois]).T
+    points = thirsty.geo.to_unit_vectors(lat, lon)
+    index = thirsty.geo.TrackIndex(track.segments, 20000)
+    expected = index.locate(points)
+
+    sizes = []
+    segment_distance = thirsty.geo.segment_distance
+    monkeypatch.setattr(thirsty.geo, "segment_distance",
+                        lambda points, starts, ends: sizes.append(len(points)) or segment_distance(points, starts, ends))
+
+    budget = 1000
+    distances, along = index.locate(points, budget=budget)
+
+    # Every POI is a candidate of every segment at this radius
+    assert sum(sizes) >= len(points) * (len(track) - 1)
+    assert max(sizes) <= budget
+    np.testing.assert_array_equal(distances, expected[0])
+    np.testing.assert_array_equal(along, expected[1])
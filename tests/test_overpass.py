@@ -0,0 +1,140 @@
+"""
+Retries and failover of Overpass queries, against local stub servers
+"""
+
+import pytest
+import requests
+
+import thirsty.cache
+import thirsty.core
+
+ELEMENT = {"type": "node", "id": 1, "lat": 43.66, "lon": 7.16, "tags": {"amenity": "drinking_water"}}
+
+
+def ok(*elements):
+    return 200, {}, {"elements": list(elements)}
+
+
+@pytest.fixture
+def delays(monkeypatch):
+    delays = []
+    monkeypatch.setattr(thirsty.core.time, "sleep", delays.append)
+    monkeypatch.setattr(thirsty.core.random, "uniform", lambda low, high: 1)
+    return delays
+
+
+def test_default_instance_only():
+    assert thirsty.core.OVERPASS_URLS == [thirsty.core.OVERPASS_URL]
+
+
+def test_failover_to_next_instance(stub, delays):
+    failing = stub((504, {}, {}))
+    working = stub(ok(ELEMENT))
+
+    assert thirsty.core.post_overpass("query", urls=[failing.url, working.url]) == [ELEMENT]
+    assert len(failing.queries) == len(working.queries) == 1
+    assert delays == []
+
+
+def test_failover_from_unreachable_instance(stub, delays):
+    unreachable = stub(ok())
+    unreachable.close()
+    working = stub(ok(ELEMENT))
+
+    assert thirsty.core.post_overpass("query", urls=[unreachable.url, working.url]) == [ELEMENT]
+
+
+def test_retry_after_is_honored(stub, delays):
+    server = stub((429, {"Retry-After": "3"}, {}), ok(ELEMENT))
+
+    assert thirsty.core.post_overpass("query", urls=[server.url]) == [ELEMENT]
+    assert delays == [3]
+
+
+def test_exponential_backoff(stub, delays):
+    server = stub((503, {}, {}), (503, {}, {}), ok(ELEMENT))
+
+    assert thirsty.core.post_overpass("query", urls=[server.url]) == [ELEMENT]
+    assert delays == [thirsty.core.OVERPASS_BACKOFF, 2 * thirsty.core.OVERPASS_BACKOFF]
+
+
+def test_backoff_once_all_instances_failed(stub, delays):
+    first = stub((503, {}, {}), ok(ELEMENT))
+    second = stub((503, {}, {}))
+
+    assert thirsty.core.post_overpass("query", urls=[first.url, second.url]) == [ELEMENT]
+    assert delays == [thirsty.core.OVERPASS_BACKOFF]
+
+
+def test_retries_exhausted(stub, delays):
+    server = stub((503, {}, {}))
+
+    with pytest.raises(requests.HTTPError):
+        thirsty.core.post_overpass("query", urls=[server.url], retries=2)
+    assert len(server.queries) == 3
+
+
+def test_client_errors_are_not_retried(stub, delays):
+    server = stub((400, {}, {}))
+
+    with pytest.raises(requests.HTTPError):
+        thirsty.core.post_overpass("query", urls=[server.url])
+    assert len(server.queries) == 1
+
+
+def test_runtime_error_remark_is_retried(stub, delays):
+    server = stub((200, {}, {"elements": [ELEMENT], "remark": "runtime error: Query timed out"}), ok())
+
+    assert thirsty.core.post_overpass("query", urls=[server.url]) == []
+    assert len(server.queries) == 2
+
+
+def test_runtime_error_remark_is_not_cached(stub, delays, tmp_path):
+    server = stub((200, {}, {"elements": [ELEMENT], "remark": "runtime error: Query timed out"}))
+    cache = thirsty.cache.Cache(str(tmp_path))
+    bbox = (43.6, 7.1, 43.7, 7.2)
+
+    with pytest.raises(thirsty.core.OverpassError):
+        thirsty.core.query_overpass(bbox, ["water"], cache=cache, urls=[server.url])
+    assert cache.get(thirsty.core.build_overpass_query(bbox, ["water"])) is None
+
+
+def test_concurrent_tiles_keep_their_order(stub, delays):
+    server = stub(ok(ELEMENT))
+    bboxes = [(43.6 + i / 10, 7.1, 43.7 + i / 10, 7.2) for i in range(6)]
+
+    results = thirsty.core.query_overpass_tiles(bboxes, ["water"], urls=[server.url], parallelism=3, progress=False)
+
+    assert results == [[ELEMENT]] * len(bboxes)
+    assert sorted(server.queries) == sorted(thirsty.core.build_overpass_query(bbox, ["water"]) for bbox in bboxes)
+
+
+def test_categories_fetched_before_a_failure_stay_cached(stub, delays, tmp_path):
+    server = stub(ok(ELEMENT), (400, {}, {}))
+    cache = thirsty.cache.Cache(str(tmp_path))
+    bbox = (43.6, 7.1, 43.7, 7.2)
+
+    with pytest.raises(requests.HTTPError):
+        thirsty.core.query_overpass(bbox, ["water"], ["toilets"], cache=cache, urls=[server.url], category_ttls={})
+    assert cache.get(thirsty.core.build_overpass_query(bbox, ["water"])) == [ELEMENT]
+    assert cache.get(thirsty.core.build_overpass_query(bbox, toilet_types=["toilets"])) is None
+
+
+def test_elements_are_compacted(stub, delays):
+    way = {"type": "way", "id": 2, "center": {"lat": 43.67, "lon": 7.17}, "nodes": [1, 2, 3],
+           "tags": {"amenity": "toilets", "building": "yes"}}
+    server = stub(ok(ELEMENT, way, {"type": "relation", "id": 3, "tags": {"amenity": "toilets"}}))
+
+    assert thirsty.core.post_overpass("query", urls=[server.url]) == [
+        ELEMENT, {"type": "way", "id": 2, "lat": 43.67, "lon": 7.17, "tags": {"amenity": "toilets"}}]
+
+
+def test_connection_pool_follows_parallelism(stub, delays, caplog):
+    server = stub(ok(ELEMENT))
+    bboxes = [(43.6 + i / 10, 7.1, 43.7 + i / 10, 7.2) for i in range(40)]
+
+    thirsty.core.query_overpass_tiles(bboxes, ["water"], urls=[server.url], parallelism=16, progress=False)
+
+    pool = thirsty.core.get_session().get_adapter(server.url).poolmanager.connection_pool_kw
+    assert pool["maxsize"] >= 16
+    assert "Connection pool is full" not in caplog.text
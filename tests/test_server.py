@@ -0,0 +1,83 @@
+"""
+Requests to the HTTP service, against a local stub of Overpass
+"""
+
+import asyncio
+import os
+
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+import aiohttp.test_utils  # noqa: E402
+
+import thirsty.server  # noqa: E402
+
+EXAMPLE = os.path.join(os.path.dirname(__file__), os.pardir, "examples", "test.gpx")
+
+WATER = {"type": "node", "id": 1, "lat": 43.66537, "lon": 7.15468, "tags": {"amenity": "drinking_water"}}
+
+GPX = '<gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1"><trk><trkseg>{}</trkseg></trk></gpx>'
+
+
+@pytest.fixture
+def post(stub):
+    server = stub((200, {}, {"elements": [WATER]}))
+    args = thirsty.server.make_parser().parse_args(["--overpass-url", server.url, "-j", "1"])
+
+    def post(data, options="-w water"):
+        async def request():
+            annotator = thirsty.server.Annotator(args)
+            app = thirsty.server.make_app(annotator)
+            async with aiohttp.test_utils.TestClient(aiohttp.test_utils.TestServer(app)) as client:
+                response = await client.post("/annotate", params={"options": options}, data=data)
+                return response.status, await response.text()
+
+        return asyncio.run(request())
+
+    return post
+
+
+def test_annotate(post):
+    with open(EXAMPLE, "rb") as f:
+        status, text = post(f.read())
+
+    assert status == 200
+    assert '<wpt lat="43.66537" lon="7.15468">' in text
+
+
+def test_invalid_coordinates(post):
+    status, text = post(GPX.format('<trkpt lat="x" lon="1"/>').encode())
+
+    assert status == 400
+    assert text.startswith("Invalid GPX trace")
+
+
+def test_missing_coordinates(post):
+    status, text = post(GPX.format('<trkpt lon="1"/>').encode())
+
+    assert status == 400
+    assert text.startswith("Invalid GPX trace")
+
+
+def test_empty_trace(post):
+    status, text = post(GPX.format("").encode())
+
+    assert status == 400
+    assert text.startswith("Invalid GPX trace")
+
+
+def test_unbalanced_quote(post):
+    status, text = post(GPX.format('<trkpt lat="43.66" lon="7.16"/>').encode(), options='-w water "oops')
+
+    assert status == 400
+    assert text.startswith("Invalid options")
+
+
+def test_ways_rejected_with_poi_db():
+    args = thirsty.server.make_parser().parse_args(["-j", "1"])
+    annotator = thirsty.server.Annotator(args, poi_db=object())
+
+    with pytest.raises(thirsty.server.RequestError, match="--ways"):
+        annotator.parse_options("-w water --ways")
+    annotator.processes.shutdown()
+    annotator.jobs.shutdown()
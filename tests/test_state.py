@@ -0,0 +1,69 @@
+"""
+Incremental annotation of edited traces, tile by tile
+"""
+
+import numpy as np
+
+import thirsty.core
+import thirsty.state
+import thirsty.track
+
+DISTANCE = 150
+
+# Water points every 0.01° along the trace, alternately on and off it
+ELEMENTS = [{"type": "node", "id": i, "lat": 43.65 + (0 if i % 2 else 0.01), "lon": 7.051 + i / 100,
+             "tags": {"amenity": "drinking_water"}}
+            for i in range(10)]
+
+
+def trace(shift=0.0):
+    # Straight trace over two corridor tiles, its point at 7.13 shifted north by shift degrees
+    lon = np.arange(7.05, 7.15, 0.005)
+    lat = np.where(np.isclose(lon, 7.13), 43.65 + shift, 43.65)
+    return thirsty.track.Track.from_segments([np.stack((lat, lon), axis=1)])
+
+
+def annotate(state, track):
+    tiles = thirsty.core.get_corridor_tiles(track, DISTANCE)
+    queries = [f"tile {key}" for key, _, _ in tiles]
+    filtered = []
+
+    def fetch(bboxes):
+        return [ELEMENTS for _ in bboxes]
+
+    def filter_pois(elements, segments):
+        filtered.append(segments)
+        return thirsty.core.filter_pois_near_track(thirsty.track.Track.from_segments(segments), elements,
+                                                   max_distance_m=DISTANCE, progress=False)
+
+    pois, fetched, refiltered, reused = thirsty.state.annotate_tiles(state, tiles, queries, fetch, filter_pois)
+    assert refiltered == len(filtered)
+    return sorted(poi.id for poi in pois), fetched, refiltered, reused
+
+
+def test_only_edited_tile_is_filtered_again(tmp_path):
+    path = str(tmp_path / "state.json.gz")
+    state = thirsty.state.State.load(path, {})
+
+    assert len(thirsty.core.get_corridor_tiles(trace(), DISTANCE)) == 2
+    assert annotate(state, trace()) == ([1, 3, 5, 7, 9], 2, 2, 0)
+    state.save(path)
+
+    # Moving the point next to the off-trace water point at 7.131 brings it within the distance
+    state = thirsty.state.State.load(path, {})
+    pois, fetched, refiltered, reused = annotate(state, trace(shift=0.01))
+
+    assert (fetched, refiltered, reused) == (0, 1, 1)
+    expected = thirsty.core.filter_pois_near_track(trace(shift=0.01), ELEMENTS, max_distance_m=DISTANCE,
+                                                   progress=False)
+    assert pois == sorted(poi.id for poi in expected) == [1, 3, 5, 7, 8, 9]
+
+
+def test_other_settings_start_over(tmp_path):
+    path = str(tmp_path / "state.json.gz")
+    state = thirsty.state.State.load(path, {"tile_size": 0.1})
+    annotate(state, trace())
+    state.save(path)
+
+    assert thirsty.state.State.load(path, {"tile_size": 0.1}).tiles == state.tiles
+    assert thirsty.state.State.load(path, {"tile_size": 0.2}).tiles == {}
@@ -0,0 +1,70 @@
+"""
+Streamed GPX output, against the gpxpy serialization it replaces
+"""
+
+import io
+import os
+
+import pytest
+
+import thirsty.core
+import thirsty.writer
+
+EXAMPLE = os.path.join(os.path.dirname(__file__), os.pardir, "examples", "test.gpx")
+
+ELEMENTS = [
+    {"type": "node", "id": 1, "lat": 43.6653, "lon": 7.15445, "tags": {"amenity": "drinking_water"}},
+    {"type": "node", "id": 2, "lat": 43.66536, "lon": 7.15468, "tags": {"amenity": "toilets", "name": "WC & co"}},
+    {"type": "node", "id": 3, "lat": 43.66541, "lon": 7.155,
+     "tags": {"shop": "bakery", "name": "Boulangerie <Paul> & fils"}},
+    {"type": "way", "id": 4, "lat": 43.6655, "lon": 7.1552, "tags": {"shop": "bicycle"}},
+]
+
+
+def example():
+    with open(EXAMPLE, "rb") as f:
+        return f.read()
+
+
+def multi_segment():
+    # The track split in two segments, and a second track with a single-point segment
+    data = example()
+    split = data.index(b"   <trkpt ", data.index(b"<trkpt ") + 1000)
+    data = data[:split] + b"  </trkseg>\n  <trkseg>\n" + data[split:]
+    return data.replace(b"</gpx>", b' <trk>\n  <name>Retour &amp; fin</name>\n  <trkseg>\n'
+                                   b'   <trkpt lat="43.67" lon="7.16"/>\n  </trkseg>\n </trk>\n</gpx>')
+
+
+def waypoints():
+    # Existing waypoints and a route, with escaped names
+    return example().replace(b" <trk>", b' <wpt lat="43.66" lon="7.16">\n  <name>Caf&#233; &amp; &lt;bar&gt;</name>\n'
+                                         b' </wpt>\n <rte>\n  <name>A &amp; B</name>\n'
+                                         b'  <rtept lat="43.66" lon="7.16"/>\n </rte>\n <trk>', 1)
+
+
+@pytest.mark.parametrize("document", [example, multi_segment, waypoints])
+@pytest.mark.parametrize("km", [False, True])
+def test_same_output_as_gpxpy(document, km):
+    data = document()
+    pois = [poi._replace(km=i * 1.25) for i, poi in enumerate(thirsty.core.classify_pois(ELEMENTS))]
+
+    # Documents in the schema order are streamed, not handed to gpxpy
+    assert thirsty.writer.scan_document(io.BytesIO(data))[3]
+
+    streamed, expected = io.StringIO(), io.StringIO()
+    written = thirsty.writer.write_gpx(io.BytesIO(data), streamed, pois, km=km)
+    expected_written = thirsty.writer._write_gpxpy(io.BytesIO(data), expected, pois, km=km)
+
+    assert streamed.getvalue() == expected.getvalue()
+    assert written == expected_written
+    assert "WC &amp; co" in streamed.getvalue()
+    assert "Boulangerie &lt;Paul&gt; &amp; fils" in streamed.getvalue()
+
+
+def test_same_output_without_pois():
+    streamed, expected = io.StringIO(), io.StringIO()
+
+    thirsty.writer.write_gpx(io.BytesIO(example()), streamed)
+    thirsty.writer._write_gpxpy(io.BytesIO(example()), expected)
+
+    assert streamed.getvalue() == expected.getvalue()
@@ -0,0 +1,196 @@
+import argparse
+import concurrent.futures
+import csv
+import functools
+import json
+import os
+import time
+
+import rich.progress
+import rich.table
+
+import thirsty.cli
+import thirsty.core
+import thirsty.metrics
+import thirsty.track
+
+console = thirsty.cli.console
+
+# Options shared with the worker processes, set by _init_worker
+_worker_state = {}
+
+
+def read_manifest(source, output_dir):
+    """
+    Return the (input, output) paths of the traces to process
+
+    source is either a directory, whose GPX files are all processed, or a
+    manifest file listing the traces: a JSON list of paths or of
+    {"input": ..., "output": ...} objects, or a CSV file with an input and
+    an optional output column. Relative paths are relative to the manifest,
+    and outputs default to the input file name in output_dir.
+    """
+
+    if os.path.isdir(source):
+        entries = [{"input": os.path.join(source, name)}
+                   for name in sorted(os.listdir(source))
+                   if name.lower().endswith(".gpx")]
+    else:
+        with open(source, newline="") as f:
+            if source.lower().endswith(".json"):
+                entries = [{"input": entry} if isinstance(entry, str) else entry
+                           for entry in json.load(f)]
+            else:
+                entries = list(csv.DictReader(f))
+
+        base = os.path.dirname(source)
+        for entry in entries:
+            entry["input"] = os.path.join(base, entry["input"])
+            if entry.get("output"):
+                entry["output"] = os.path.join(base, entry["output"])
+
+    return [(entry["input"], entry.get("output") or os.path.join(output_dir, os.path.basename(entry["input"])))
+            for entry in entries]
+
+
+def _init_worker(pois, max_distance_m, type_distances, html, fast_map, map_tolerance, km):
+    # Instrumentation inherited by forked workers would only record their own stages
+    thirsty.metrics.enable(None)
+
+    # POIs are sent once per worker process rather than once per trace
+    _worker_state.update(pois=pois, max_distance_m=max_distance_m, type_distances=type_distances,
+                         html=html, fast_map=fast_map, map_tolerance=map_tolerance, km=km)
+
+
+def process_trace(input_path, output_path):
+    """
+    Add the shared POIs near a trace to it, in a worker process
+
+    Return the number of POIs added.
+    """
+
+    with open(input_path, "rb") as input:
+        track = thirsty.track.read_track(input)
+        pois = thirsty.core.filter_pois_near_track(track, _worker_state["pois"],
+                                                   max_distance_m=_worker_state["max_distance_m"],
+                                                   type_distances=_worker_state["type_distances"],
+                                                   progress=False)
+
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        with open(output_path, "w") as output:
+            thirsty.cli.write_output(track, pois, output, html=_worker_state["html"],
+                                     fast_map=_worker_state["fast_map"], map_tolerance=_worker_state["map_tolerance"],
+                                     km=_worker_state["km"])
+
+    return len(pois)
+
+
+def _timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="thirsty batch",
+                                     description="Add water, toilet, bicycle repair, and food POIs to many GPX traces, "
+                                                 "fetching the POIs once for all of them.")
+
+    parser.add_argument("source", help="directory of GPX traces, or JSON/CSV manifest listing them")
+
+    parser.add_argument("output_dir", help="directory of the output GPX traces")
+
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="number of traces processed in parallel")
+
+    thirsty.cli.add_poi_arguments(parser)
+    thirsty.cli.add_overpass_arguments(parser)
+    thirsty.cli.add_metrics_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    cache = thirsty.cli.get_cache(parser, args)
+    poi_db = thirsty.cli.get_poi_db(parser, args)
+    metrics = thirsty.cli.get_metrics(args)
+    entries = read_manifest(args.source, args.output_dir)
+    water_types, toilet_types, repair_types, food_types = thirsty.cli.get_poi_types(args)
+    type_distances = thirsty.cli.get_type_distances(args)
+
+    # Results by input path: (number of POIs, seconds, error)
+    results = {}
+
+    # Read all the traces first, to fetch the POIs of their union corridor
+    tracks = []
+    with thirsty.metrics.stage("read_traces"):
+        for input_path, _ in rich.progress.track(entries, description="Reading traces"):
+            try:
+                with open(input_path, "rb") as input:
+                    track = thirsty.track.read_track(input)
+                track.source = None
+                tracks.append(track)
+            except Exception as e:
+                results[input_path] = (None, 0, e)
+    thirsty.metrics.count("traces", len(entries))
+    thirsty.metrics.count("points", sum(len(track) for track in tracks))
+
+    buffer_m = max([args.distance, *type_distances.values()])
+    bboxes = thirsty.core.get_corridor_bounds(thirsty.track.concatenate(tracks), buffer_m, tile_size=args.tile_size)
+
+    try:
+        with thirsty.metrics.stage("query_overpass"):
+            pois, seconds = _timed(functools.partial(thirsty.core.query_overpass_corridor,
+                                                     category_ttls=thirsty.cli.get_category_ttls(args),
+                                                     ways=args.ways),
+                                   bboxes, water_types, toilet_types, repair_types, food_types,
+                                   cache, args.offline, args.overpass_url, args.parallel, poi_db)
+    except (thirsty.core.OfflineError, thirsty.core.OverpassError) as e:
+        console.print(f"❌ {e}")
+        raise SystemExit(1) from e
+
+    console.print(f"Fetched {len(pois)} POI over {len(bboxes)} tiles in {seconds:.1f}s")
+    thirsty.metrics.count("pois_fetched", len(pois))
+
+    # Classify the POIs once for all the traces
+    with thirsty.metrics.stage("classify_pois"):
+        pois = thirsty.core.classify_pois(pois)
+
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=max(args.jobs, 1), initializer=_init_worker,
+                                                      initargs=(pois, args.distance, type_distances, args.html,
+                                                                args.html_fast, args.html_tolerance, args.km))
+
+    with thirsty.metrics.stage("process_traces"), executor:
+        futures = {executor.submit(_timed, process_trace, input_path, output_path): input_path
+                   for input_path, output_path in entries
+                   if input_path not in results}
+
+        with rich.progress.Progress() as progress:
+            task = progress.add_task("Processing traces", total=len(futures))
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    count, seconds = future.result()
+                    results[futures[future]] = (count, seconds, None)
+                except Exception as e:
+                    results[futures[future]] = (None, 0, e)
+                progress.advance(task)
+
+    table = rich.table.Table(title="Batch results")
+    table.add_column("Trace")
+    table.add_column("POI", justify="right")
+    table.add_column("Time", justify="right")
+    table.add_column("Status")
+
+    failures = 0
+    for input_path, output_path in entries:
+        count, seconds, error = results[input_path]
+        if error is None:
+            table.add_row(input_path, str(count), f"{seconds:.2f}s", f"✅ {output_path}")
+        else:
+            failures += 1
+            table.add_row(input_path, "-", "-", f"❌ {type(error).__name__}: {error}")
+
+    console.print(table)
+    console.print(f"{'❌' if failures else '✅'} Processed {len(entries) - failures}/{len(entries)} traces")
+
+    thirsty.cli.report_metrics(metrics, args)
+
+    return 1 if failures else 0
@@ -0,0 +1,386 @@
+import collections
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+# Default time-to-live of cached entries (in seconds)
+DEFAULT_TTL = 7 * 24 * 3600
+
+# Default maximum total size of the cache (in bytes)
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+
+# Default number of entries kept by a MemoryCache
+DEFAULT_MEMORY_ENTRIES = 256
+
+# First bytes of gzip-compressed files
+GZIP_MAGIC = b"\x1f\x8b"
+
+# Size of the buffer used to decompress files (in bytes)
+COPY_BUFFER_SIZE = 1 << 20
+
+
+def is_gzip(f):
+    """
+    Return whether a seekable binary file object is gzip-compressed, rewinding it
+    """
+
+    f.seek(0)
+    magic = f.read(len(GZIP_MAGIC))
+    f.seek(0)
+    return magic == GZIP_MAGIC
+
+
+def decompress(source, output):
+    """
+    Write the decompressed content of a gzip-compressed binary file object to output
+    """
+
+    source.seek(0)
+    with gzip.GzipFile(fileobj=source, mode="rb") as f:
+        shutil.copyfileobj(f, output, COPY_BUFFER_SIZE)
+
+
+def evict_files(directory, suffix, max_size, companions=()):
+    """
+    Remove the least recently used files with a suffix until they fit a maximum total size, and return their
+    remaining total size
+
+    suffix: suffix, or tuple of suffixes, of the files
+    companions: suffixes appended to the path of the files, of other files removed with them
+    """
+
+    if max_size is None:
+        return None
+
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.name.endswith(suffix):
+            # Entries may be removed concurrently
+            with contextlib.suppress(FileNotFoundError):
+                stat = entry.stat()
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        for name in (path, *(path + companion for companion in companions)):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(name)
+        total -= size
+
+    return total
+
+
+def write_json(path, value, compress=False):
+    """
+    Write a JSON value to path, gzip-compressed with compress, replacing it atomically
+    """
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as raw, (gzip.open(raw, "wt", encoding="utf-8") if compress
+                                          else io.TextIOWrapper(raw, encoding="utf-8")) as f:
+            json.dump(value, f, separators=(",", ":"))
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+class Cache:
+    """
+    Directory of gzip-compressed JSON entries
+
+    Entries expire after a time-to-live, and the least recently used ones
+    are evicted once the directory grows above its maximum size. The total
+    size is measured on the first write, then tracked across writes, so
+    that the directory is only scanned again once it is exceeded.
+    """
+
+    SUFFIX = ".json.gz"
+
+    def __init__(self, directory, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self._size = None
+        self._size_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        """
+        Return the file path of the entry for a key
+        """
+
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest + self.SUFFIX)
+
+    def get(self, key, ttl=None):
+        """
+        Return the cached value for a key, or None if missing or expired
+        """
+
+        entry = self.get_entry(key, ttl=ttl)
+        return None if entry is None else entry[1]
+
+    def get_entry(self, key, ttl=None):
+        """
+        Return the write time and the cached value for a key, or None if missing or expired
+        """
+
+        if ttl is None:
+            ttl = self.ttl
+
+        path = self.path(key)
+
+        try:
+            mtime = os.stat(path).st_mtime
+            if ttl is not None and time.time() - mtime > ttl:
+                os.remove(path)
+                return None
+
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                value = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError):
+            # Truncated or corrupted entry, drop it
+            self.remove(key)
+            return None
+
+        # Record the access for the eviction, keeping the write time for the
+        # TTL, unless another thread evicted the entry meanwhile
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(path, (time.time(), mtime))
+        return mtime, value
+
+    def set(self, key, value):
+        """
+        Store a value for a key, then evict old entries if the cache is too big
+        """
+
+        path = self.path(key)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as raw, gzip.open(raw, "wt", encoding="utf-8") as f:
+                json.dump(value, f, separators=(",", ":"))
+            size = os.path.getsize(tmp)
+            with contextlib.suppress(FileNotFoundError):
+                size -= os.path.getsize(path)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+        with self._size_lock:
+            if self._size is not None:
+                self._size += size
+            if self._size is None or (self.max_size is not None and self._size > self.max_size):
+                self._size = evict_files(self.directory, self.SUFFIX, self.max_size)
+
+    def remove(self, key):
+        """
+        Remove the entry for a key, if any
+        """
+
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path(key))
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits its maximum size
+        """
+
+        with self._size_lock:
+            self._size = evict_files(self.directory, self.SUFFIX, self.max_size)
+
+
+class DownloadCache:
+    """
+    Directory of downloaded documents by URL, with the headers to revalidate and resume them
+
+    Each document is stored decompressed, with the ETag and Last-Modified
+    headers of its response in a .json file next to it. Interrupted
+    downloads are kept as .part files, with their own headers, until they
+    are resumed. The least recently used documents and partial downloads
+    are evicted once the directory grows above its maximum size.
+    """
+
+    SUFFIX = ".gpx"
+
+    # Suffix of the partial downloads
+    PART_SUFFIX = ".part"
+
+    # Suffix appended to the path of a file, of the headers of its response
+    HEADERS_SUFFIX = ".json"
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, url, suffix=SUFFIX):
+        """
+        Return the file path of the document of a URL, or of its partial download with PART_SUFFIX
+        """
+
+        digest = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest + suffix)
+
+    def headers(self, path):
+        """
+        Return the headers saved with a document or partial download, or None if missing
+        """
+
+        try:
+            with open(path + self.HEADERS_SUFFIX, encoding="utf-8") as f:
+                headers = json.load(f)
+            os.stat(path)
+        except (OSError, ValueError):
+            return None
+        return headers
+
+    def get(self, url):
+        """
+        Return the path of the cached document of a URL and the headers of its response, or None if missing
+        """
+
+        path = self.path(url)
+        headers = self.headers(path)
+        return None if headers is None else (path, headers)
+
+    def touch(self, url):
+        """
+        Record an access to the document of a URL for the eviction
+        """
+
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(self.path(url))
+
+    def set_partial_headers(self, url, headers):
+        """
+        Save the headers of the response being written to the partial download of a URL
+        """
+
+        write_json(self.path(url, self.PART_SUFFIX) + self.HEADERS_SUFFIX, headers)
+
+    def discard_partial(self, url, empty_only=False):
+        """
+        Remove the partial download of a URL and its headers, or only if it holds no data with empty_only
+        """
+
+        part = self.path(url, self.PART_SUFFIX)
+        with contextlib.suppress(FileNotFoundError):
+            if empty_only and os.path.getsize(part):
+                return
+            os.remove(part)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(part + self.HEADERS_SUFFIX)
+
+    def commit(self, url, headers):
+        """
+        Store the completed partial download of a URL as its document, decompressing it, and return its path
+        """
+
+        part = self.path(url, self.PART_SUFFIX)
+        path = self.path(url)
+
+        with open(part, "rb") as source:
+            gzipped = is_gzip(source)
+            if gzipped:
+                fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+                try:
+                    with os.fdopen(fd, "wb") as output:
+                        decompress(source, output)
+                    os.replace(tmp, path)
+                except BaseException:
+                    os.remove(tmp)
+                    raise
+        if gzipped:
+            os.remove(part)
+        else:
+            os.replace(part, path)
+
+        write_json(path + self.HEADERS_SUFFIX, headers)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(part + self.HEADERS_SUFFIX)
+
+        self.evict()
+        return path
+
+    def evict(self):
+        """
+        Remove the least recently used documents and partial downloads until the cache fits its maximum size
+        """
+
+        evict_files(self.directory, (self.SUFFIX, self.PART_SUFFIX), self.max_size, companions=(self.HEADERS_SUFFIX,))
+
+
+class MemoryCache:
+    """
+    In-memory layer of least recently used entries, in front of an optional Cache
+
+    Meant for long-running processes, where the same queries come back often
+    and decompressing entries from disk each time would be wasted.
+    """
+
+    def __init__(self, backend=None, max_entries=DEFAULT_MEMORY_ENTRIES, ttl=DEFAULT_TTL):
+        self.backend = backend
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, ttl=None):
+        """
+        Return the cached value for a key, or None if missing or expired
+        """
+
+        if ttl is None:
+            ttl = self.ttl
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored, value = entry
+                if ttl is None or time.time() - stored <= ttl:
+                    self._entries.move_to_end(key)
+                    return value
+                del self._entries[key]
+
+        if self.backend is None:
+            return None
+
+        entry = self.backend.get_entry(key, ttl=ttl)
+        if entry is None:
+            return None
+
+        # Entries keep expiring from their write time to the backend
+        stored, value = entry
+        self._remember(key, value, stored)
+        return value
+
+    def set(self, key, value):
+        """
+        Store a value for a key, in memory and in the backend
+        """
+
+        self._remember(key, value, time.time())
+        if self.backend is not None:
+            self.backend.set(key, value)
+
+    def _remember(self, key, value, stored):
+        with self._lock:
+            self._entries[key] = (stored, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
@@ -1,71 +1,232 @@
 import argparse
+import io
+import json
+import os
+import sqlite3
+import sys
 
-import gpxpy
 import rich.console
 import rich.progress
+import rich.table
 
+import thirsty.cache
 import thirsty.core
+import thirsty.metrics
+import thirsty.poidb
+import thirsty.state
+import thirsty.track
+import thirsty.writer
 
 console = rich.console.Console()
 
 
-def main():
-    default_water = next(iter(thirsty.core.WATER_AMENITIES))
-    default_toilet = next(iter(thirsty.core.TOILET_AMENITIES))
-    default_repair = next(iter(thirsty.core.REPAIR_AMENITIES))
-    default_food = next(iter(thirsty.core.FOOD_AMENITIES))
-
-    parser = argparse.ArgumentParser(description="Add water, toilet, bicycle repair, and food POIs to a GPX trace.")
-
-    parser.add_argument("input", help="input GPX trace")
+def add_poi_arguments(parser):
+    """
+    Add POI selection and distance arguments to a parser
+    """
 
-    parser.add_argument("output", help="output GPX trace",
-                        type=argparse.FileType("w"))
+    default_water = next(iter(thirsty.core.WATER_AMENITIES))
 
     parser.add_argument("-d", "--distance", type=float, default=100,
                         help="default search distance around trace (in meters)")
-                        
+
     parser.add_argument("--water-distance", type=float, default=None,
                         help="search distance for water points (in meters)")
-                        
+
     parser.add_argument("--toilet-distance", type=float, default=None,
                         help="search distance for toilets (in meters)")
-                        
+
     parser.add_argument("--repair-distance", type=float, default=None,
                         help="search distance for repair stations (in meters)")
-                        
+
     parser.add_argument("--food-distance", type=float, default=None,
                         help="search distance for food amenities (in meters)")
 
+    parser.add_argument("--km", action="store_true",
+                        help="add the along-track distance (in km) to the waypoint descriptions, and sort them along "
+                             "the trace")
+
     parser.add_argument("--html", action="store_true",
                         help="generate HTML interactive map to <output>.html")
 
+    parser.add_argument("--html-fast", action="store_true",
+                        help="generate a lighter HTML map, with a simplified trace and clustered POIs (implies --html)")
+
+    parser.add_argument("--html-tolerance", type=float, default=thirsty.core.MAP_TOLERANCE,
+                        help="tolerance of the trace simplification of --html-fast (in meters)")
+
     parser.add_argument("-w", "--water", action="append",
                         choices=thirsty.core.WATER_AMENITIES.keys(), default=None,
                         help=f"set which type of water amenities to consider (default: {default_water})")
-                        
+
     parser.add_argument("-t", "--toilet", action="store_true",
                         help="add toilet amenities to the trace")
-                        
+
     parser.add_argument("-r", "--repair", action="append",
                         choices=thirsty.core.REPAIR_AMENITIES.keys(), default=None,
-                        help=f"add bicycle repair amenities to the trace (can be repeated)")
-                        
+                        help="add bicycle repair amenities to the trace (can be repeated)")
+
     parser.add_argument("-f", "--food", action="append",
                         choices=thirsty.core.FOOD_AMENITIES.keys(), default=None,
-                        help=f"add food and refreshment amenities to the trace (can be repeated)")
+                        help="add food and refreshment amenities to the trace (can be repeated)")
+
+    parser.add_argument("--ways", action="store_true",
+                        help="also add POIs mapped as ways and relations, e.g. toilet buildings and shops, at their "
+                             "center (not supported with --poi-db)")
 
     # Keep backward compatibility with -p argument
     parser.add_argument("-p", "--poi-type", action="append",
                         choices=thirsty.core.WATER_AMENITIES.keys(), default=None,
-                        help=f"DEPRECATED: use -w instead")
+                        help="DEPRECATED: use -w instead")
 
-    args = parser.parse_args()
 
-    if args.input.startswith("http"):
-        input = thirsty.core.download_gpx(args.input)
-    else:
-        input = open(args.input, "rb") # noqa: SIM115
+def add_overpass_arguments(parser):
+    """
+    Add Overpass querying and caching arguments to a parser
+    """
+
+    parser.add_argument("--tile-size", type=float, default=thirsty.core.CORRIDOR_TILE_SIZE,
+                        help="size of the corridor tiles (in degrees)")
+
+    parser.add_argument("--overpass-url", action="append", default=None,
+                        help="Overpass API instance to query, tried in turn on failure (can be repeated, "
+                             f"default: {', '.join(thirsty.core.OVERPASS_URLS)})")
+
+    parser.add_argument("--parallel", type=int, default=thirsty.core.OVERPASS_PARALLELISM,
+                        help="maximum number of concurrent Overpass queries in corridor mode")
+
+    parser.add_argument("--cache-dir", default=None,
+                        help="cache Overpass responses, and downloaded traces, in this directory")
+
+    parser.add_argument("--cache-ttl", type=float, default=thirsty.cache.DEFAULT_TTL,
+                        help="time after which cached Overpass responses are refreshed (in seconds)")
+
+    parser.add_argument("--split-categories", action="store_true",
+                        help="query and cache each POI category on its own, one after the other, so that "
+                             "categories are refreshed separately and those fetched before a failure stay cached")
+
+    for category in thirsty.core.QUERY_CATEGORIES:
+        parser.add_argument(f"--{category}-ttl", type=float, default=None,
+                            help=f"time after which cached {category} POIs are refreshed, instead of --cache-ttl "
+                                 "(in seconds, implies --split-categories)")
+
+    parser.add_argument("--cache-max-size", type=float, default=thirsty.cache.DEFAULT_MAX_SIZE / 2**20,
+                        help="maximum size of the cache directory (in MiB)")
+
+    parser.add_argument("--offline", action="store_true",
+                        help="only use cached Overpass responses and downloaded traces, never query the network")
+
+    parser.add_argument("--poi-db", default=None,
+                        help="answer POI queries from a local database built by 'thirsty index' instead of Overpass")
+
+
+def add_metrics_arguments(parser):
+    """
+    Add instrumentation arguments to a parser
+    """
+
+    parser.add_argument("--profile", action="store_true",
+                        help="print the time and memory used by each stage of the pipeline")
+
+    parser.add_argument("--metrics-out", default=None,
+                        help="write the metrics of each stage as JSON to this file")
+
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="trace the Python allocations of each stage with tracemalloc (slower)")
+
+    parser.add_argument("--profile-dir", default=None,
+                        help="write a cProfile dump of each stage to this directory")
+
+    parser.add_argument("--profile-stage", action="append", default=None,
+                        help="only dump the profile of this stage (can be repeated)")
+
+
+def get_metrics(args):
+    """
+    Return the metrics recorder selected by the arguments, if any, and enable it
+    """
+
+    if not (args.profile or args.metrics_out or args.trace_memory or args.profile_dir):
+        return None
+
+    metrics = thirsty.metrics.Metrics(trace_memory=args.trace_memory, profile_dir=args.profile_dir,
+                                      profile_stages=args.profile_stage)
+    thirsty.metrics.enable(metrics)
+    return metrics
+
+
+def report_metrics(metrics, args):
+    """
+    Print and write the recorded metrics as requested by the arguments
+    """
+
+    if metrics is None:
+        return
+
+    thirsty.metrics.enable(None)
+
+    if args.profile or not args.metrics_out:
+        console.print(metrics.table())
+
+    if args.metrics_out:
+        metrics.write(args.metrics_out)
+        console.print(f"📊 Metrics written to {args.metrics_out}")
+
+    if args.profile_dir:
+        console.print(f"📊 Profiles written to {args.profile_dir}")
+
+
+def get_cache(parser, args):
+    """
+    Return the Overpass cache selected by the arguments, if any
+    """
+
+    if args.offline and args.cache_dir is None:
+        parser.error("--offline requires --cache-dir")
+
+    if args.cache_dir is None:
+        return None
+
+    return thirsty.cache.Cache(args.cache_dir, ttl=args.cache_ttl,
+                               max_size=int(args.cache_max_size * 2**20))
+
+
+def get_download_cache(args):
+    """
+    Return the cache of downloaded traces selected by the arguments, if any
+    """
+
+    if args.cache_dir is None:
+        return None
+
+    return thirsty.cache.DownloadCache(os.path.join(args.cache_dir, "downloads"),
+                                       max_size=int(args.cache_max_size * 2**20))
+
+
+def get_poi_db(parser, args):
+    """
+    Return the local POI database selected by the arguments, if any
+    """
+
+    if args.poi_db is None:
+        return None
+
+    # The database only indexes nodes
+    if getattr(args, "ways", False):
+        parser.error("--ways is not supported with --poi-db")
+
+    try:
+        return thirsty.poidb.PoiDatabase(args.poi_db)
+    except (OSError, KeyError, sqlite3.Error) as e:
+        parser.error(f"cannot open POI database {args.poi_db}: {e}")
+
+
+def get_poi_types(args, verbose=True):
+    """
+    Return the selected (water, toilet, repair, food) POI types, and print them if verbose
+    """
+
+    default_toilet = next(iter(thirsty.core.TOILET_AMENITIES))
 
     # Handle backward compatibility
     if args.poi_type is not None:
@@ -73,42 +234,48 @@ def main():
             args.water = args.poi_type
         else:
             args.water.extend(args.poi_type)
-            
+
     # No default options anymore - user must explicitly select water amenities
-    
+
     toilet_types = []
     if args.toilet:
         toilet_types = [default_toilet]
-        
+
     repair_types = args.repair
-    
+
     food_types = args.food
 
+    if not verbose:
+        return args.water, toilet_types, repair_types, food_types
+
     if args.water:
         console.print(f"Selected water amenities: {args.water}")
     else:
         console.print("No water amenities selected")
-        
+
     if args.toilet:
         console.print(f"Selected toilet amenities: {toilet_types}")
     else:
         console.print("No toilet amenities selected")
-        
+
     if repair_types:
         console.print(f"Selected repair amenities: {repair_types}")
     else:
         console.print("No repair amenities selected")
-        
+
     if food_types:
         console.print(f"Selected food amenities: {food_types}")
     else:
         console.print("No food amenities selected")
 
-    gpx = gpxpy.parse(input)
-    bounds = thirsty.core.get_bounds(gpx)
-    pois = thirsty.core.query_overpass(bounds, args.water, toilet_types, repair_types, food_types)
-    
-    # Set up type-specific distances
+    return args.water, toilet_types, repair_types, food_types
+
+
+def get_type_distances(args):
+    """
+    Return the type-specific search distances
+    """
+
     type_distances = {}
     if args.water_distance is not None:
         type_distances["WATER"] = args.water_distance
@@ -118,16 +285,251 @@ def main():
         type_distances["GEAR"] = args.repair_distance
     if args.food_distance is not None:
         type_distances["FOOD"] = args.food_distance
-        
-    pois = thirsty.core.filter_pois_near_track(gpx, pois, max_distance_m=args.distance, type_distances=type_distances)
-    gpx = thirsty.core.add_waypoints_to_gpx(gpx, pois)
+    return type_distances
+
+
+def get_category_ttls(args):
+    """
+    Return the cache TTLs by POI category, or None when the categories are queried together
+    """
+
+    category_ttls = {category: getattr(args, f"{category}_ttl") for category in thirsty.core.QUERY_CATEGORIES
+                     if getattr(args, f"{category}_ttl") is not None}
+    if not args.split_categories and not category_ttls:
+        return None
+    return category_ttls
+
+
+def render_gpx(track, pois, km=False):
+    """
+    Return the GPX document of a track with POIs added as waypoints
+
+    km: whether to add the along-track distance to the waypoints
+    """
+
+    output = io.StringIO()
+    with thirsty.metrics.stage("write_gpx"):
+        thirsty.writer.write_gpx(track.source, output, pois, km=km)
+    return output.getvalue()
+
+
+def write_output(track, pois, output, html=False, fast_map=False, map_tolerance=thirsty.core.MAP_TOLERANCE,
+                 km=False):
+    """
+    Write the GPX document of a track with POIs added as waypoints
+
+    output: text file object to write to
+    km: whether to add the along-track distance to the waypoints
+    html: whether to generate the HTML map to <output>.html too
+    fast_map, map_tolerance: see thirsty.core.display_gpx_on_map
+    """
+
+    if html or fast_map:
+        with thirsty.metrics.stage("html_map"):
+            map = thirsty.core.display_gpx_on_map(track, pois, fast=fast_map, tolerance_m=map_tolerance)
+            map.save(output.name + ".html")
+
+    # The original document is streamed to the output, track point by track point
+    with thirsty.metrics.stage("write_gpx"):
+        written = thirsty.writer.write_gpx(track.source, output, pois, km=km)
+    thirsty.metrics.count("output_bytes", written)
+
+
+def query_pois(track, args, poi_types, type_distances, cache=None, poi_db=None, progress=True):
+    """
+    Return the POIs of the bounding box of the track, or of its corridor tiles
+    """
+
+    with thirsty.metrics.stage("query_overpass"):
+        if args.corridor:
+            buffer_m = max([args.distance, *type_distances.values()])
+            bboxes = thirsty.core.get_corridor_bounds(track, buffer_m, tile_size=args.tile_size)
+            pois = thirsty.core.query_overpass_corridor(bboxes, *poi_types, cache=cache, offline=args.offline,
+                                                        urls=args.overpass_url, parallelism=args.parallel,
+                                                        poi_db=poi_db, progress=progress,
+                                                        category_ttls=get_category_ttls(args), ways=args.ways)
+        else:
+            bounds = thirsty.core.get_bounds(track)
+            pois = thirsty.core.query_overpass(bounds, *poi_types, cache=cache, offline=args.offline,
+                                               urls=args.overpass_url, poi_db=poi_db,
+                                               category_ttls=get_category_ttls(args), ways=args.ways)
+    thirsty.metrics.count("pois_fetched", len(pois))
+    return pois
+
+
+def query_and_filter(track, args, poi_types, type_distances, cache=None, poi_db=None, jobs=1):
+    """
+    Return the POIs near the track, querying its bounding box or its corridor tiles
+    """
+
+    pois = query_pois(track, args, poi_types, type_distances, cache=cache, poi_db=poi_db)
+
+    with thirsty.metrics.stage("filter_pois"):
+        return thirsty.core.filter_pois_near_track(track, pois, max_distance_m=args.distance,
+                                                   type_distances=type_distances, jobs=jobs)
+
+
+def annotate_incremental(track, args, poi_types, type_distances, cache=None, poi_db=None):
+    """
+    Return the POIs near the track, reusing the results of the previous run saved to args.state
+
+    Only the corridor tiles where the trace changed are filtered again, and
+    only those whose query changed, or is older than the cache TTL (the
+    shortest category TTL with --split-categories), are fetched again. The
+    state is then updated for the next run.
+    """
+
+    category_ttls = get_category_ttls(args)
+    ttl = min([args.cache_ttl, *(category_ttls or {}).values()])
+
+    buffer_m = max([args.distance, *type_distances.values()])
+    tiles = thirsty.core.get_corridor_tiles(track, buffer_m, tile_size=args.tile_size)
+    queries = [thirsty.core.build_overpass_query(bbox, *poi_types, ways=args.ways) for _, bbox, _ in tiles]
+
+    settings = {"tile_size": args.tile_size, "poi_db": os.path.abspath(args.poi_db) if args.poi_db else None}
+    state = thirsty.state.State.load(args.state, settings)
+
+    def fetch(bboxes):
+        if not bboxes:
+            return []
+        return thirsty.core.query_overpass_tiles(bboxes, *poi_types, cache=cache, offline=args.offline,
+                                                 urls=args.overpass_url, parallelism=args.parallel, poi_db=poi_db,
+                                                 category_ttls=category_ttls, ways=args.ways)
+
+    def filter_pois(elements, segments):
+        return thirsty.core.filter_pois_near_track(thirsty.track.Track.from_segments(segments), elements,
+                                                   max_distance_m=args.distance, type_distances=type_distances,
+                                                   progress=False, jobs=args.jobs)
+
+    filter_key = json.dumps([args.distance, type_distances], sort_keys=True)
+    pois, fetched, filtered, reused = thirsty.state.annotate_tiles(state, tiles, queries, fetch, filter_pois,
+                                                                   filter_key=filter_key, ttl=ttl)
+    state.save(args.state)
+
+    # Tiles measured the along-track distances on their own segments only
+    pois = thirsty.core.locate_pois(track, pois, max_distance_m=buffer_m)
+
+    console.print(f"♻️  Reused {reused}/{len(tiles)} tiles, fetched {fetched} and filtered {filtered} again")
+    return pois
+
 
-    if args.html:
-        map = thirsty.core.display_gpx_on_map(gpx, pois)
-        map.save(args.output.name + ".html")
+def print_gaps(track, pois, count, poi_type="WATER"):
+    """
+    Print the longest stretches of the track without POIs of a type
+    """
 
-    gpx = thirsty.core.sanitize_gpx_text(gpx.to_xml())
+    length_m = thirsty.core.track_length(track)
+    gaps = thirsty.core.find_gaps(pois, length_m, poi_type=poi_type)
 
-    args.output.write(gpx)
+    table = rich.table.Table(title=f"Longest stretches without {poi_type} POI ({length_m / 1000:.1f} km trace)")
+    table.add_column("From")
+    table.add_column("To")
+    table.add_column("Start", justify="right")
+    table.add_column("End", justify="right")
+    table.add_column("Length", justify="right")
+
+    for gap in gaps[:count]:
+        table.add_row(gap.start, gap.end, f"km {gap.start_km:.1f}", f"km {gap.end_km:.1f}", f"{gap.length_km:.1f} km")
+
+    console.print(table)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    if argv and argv[0] == "batch":
+        # Imported here as thirsty.batch depends on this module
+        import thirsty.batch as batch
+        return batch.main(argv[1:])
+
+    if argv and argv[0] == "index":
+        return thirsty.poidb.main(argv[1:])
+
+    if argv and argv[0] == "serve":
+        # Imported here as thirsty.server depends on this module
+        import thirsty.server as server
+        return server.main(argv[1:])
+
+    parser = argparse.ArgumentParser(description="Add water, toilet, bicycle repair, and food POIs to a GPX trace.",
+                                     epilog="Use 'thirsty batch --help' to process several traces at once, "
+                                            "'thirsty index --help' to build a local POI database, and "
+                                            "'thirsty serve --help' to run the HTTP service.")
+
+    parser.add_argument("input", help="input GPX trace")
+
+    parser.add_argument("output", help="output GPX trace",
+                        type=argparse.FileType("w"))
+
+    add_poi_arguments(parser)
+
+    parser.add_argument("--corridor", action="store_true",
+                        help="query Overpass over a chain of small tiles along the trace instead of its whole bounding box")
+
+    parser.add_argument("--gaps", type=int, nargs="?", const=5, default=None, metavar="N",
+                        help="print the N longest stretches of the trace without water points, or --gap-type POIs "
+                             "(default: 5)")
+
+    parser.add_argument("--gap-type", choices=[poi_type for poi_type, _, _ in thirsty.core.POI_CATEGORIES],
+                        default="WATER", help="POI type of the --gaps report (default: WATER)")
+
+    parser.add_argument("--state", default=None,
+                        help="save the results by corridor tile to this file, and only query and filter again the "
+                             "tiles where the trace changed since the previous run (implies --corridor)")
+
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes filtering the POIs, worth it with hundreds of thousands of POIs "
+                             "(default: 1)")
+
+    add_overpass_arguments(parser)
+
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    cache = get_cache(parser, args)
+
+    poi_db = get_poi_db(parser, args)
+
+    metrics = get_metrics(args)
+
+    if args.input.startswith("http"):
+        with thirsty.metrics.stage("download"):
+            try:
+                input = thirsty.core.download_gpx(args.input, cache=get_download_cache(args), offline=args.offline)
+            except thirsty.core.OfflineError as e:
+                console.print(f"❌ {e}")
+                raise SystemExit(1) from e
+    else:
+        input = open(args.input, "rb") # noqa: SIM115
+
+    poi_types = get_poi_types(args)
+
+    with thirsty.metrics.stage("read_track"):
+        track = thirsty.track.read_track(input)
+    thirsty.metrics.count("points", len(track))
+    thirsty.metrics.count("segments", len(track.offsets) - 1)
+
+    type_distances = get_type_distances(args)
+
+    try:
+        if args.state:
+            with thirsty.metrics.stage("incremental"):
+                pois = annotate_incremental(track, args, poi_types, type_distances, cache=cache, poi_db=poi_db)
+        else:
+            pois = query_and_filter(track, args, poi_types, type_distances, cache=cache, poi_db=poi_db,
+                                    jobs=args.jobs)
+    except (thirsty.core.OfflineError, thirsty.core.OverpassError) as e:
+        console.print(f"❌ {e}")
+        raise SystemExit(1) from e
+    thirsty.metrics.count("pois_added", len(pois))
+
+    write_output(track, pois, args.output, html=args.html, fast_map=args.html_fast, map_tolerance=args.html_tolerance,
+                 km=args.km)
 
     console.print(f"✅ Added {len(pois)} POI to {args.output.name}")
+
+    if args.gaps:
+        print_gaps(track, pois, args.gaps, poi_type=args.gap_type)
+
+    report_metrics(metrics, args)
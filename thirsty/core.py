@@ -1,18 +1,79 @@
+import concurrent.futures
+import email.utils
+import html
 import io
 import math
+import random
 import re
+import tempfile
+import threading
+import time
+import typing
 
-import folium
-import gpxpy
-import requests
+import numpy as np
 import rich.console
 import rich.progress
 
+import thirsty.cache
+import thirsty.geo
+import thirsty.metrics
+import thirsty.parallel
+import thirsty.track
+
 console = rich.console.Console()
 
 
 OVERPASS_URL = "http://overpass-api.de/api/interpreter"
 
+# Overpass instances tried in turn when a query fails, mirrors are only
+# queried when chosen with --overpass-url
+OVERPASS_URLS = [OVERPASS_URL]
+
+# Maximum number of concurrent Overpass queries
+OVERPASS_PARALLELISM = 2
+
+# Minimum number of connections kept alive per host by the HTTP session
+HTTP_POOL_SIZE = 10
+
+# Number of times a failed Overpass query is retried
+OVERPASS_RETRIES = 4
+
+# Delay before the first retry, doubled at each attempt (in seconds)
+OVERPASS_BACKOFF = 2
+
+# Longest wait between two attempts (in seconds)
+OVERPASS_MAX_DELAY = 120
+
+# HTTP timeout of Overpass queries (in seconds)
+OVERPASS_TIMEOUT = 90
+
+# Number of decimals kept in the Overpass query bounding boxes
+BBOX_PRECISION = 2
+
+# Size of the tiles along the trace in corridor mode (in degrees)
+CORRIDOR_TILE_SIZE = 0.1
+
+# OSM element types, in the order of Overpass responses
+OSM_TYPES = ("node", "way", "relation")
+
+# POI categories queried separately with per-category TTLs, as in the query_overpass arguments
+QUERY_CATEGORIES = ("water", "toilet", "repair", "food")
+
+# Number of POIs measured at once against the track
+FILTER_BATCH_SIZE = 4096
+
+# Size of the chunks read from GPX downloads (in bytes)
+DOWNLOAD_CHUNK_SIZE = 1 << 16
+
+# Number of times an interrupted GPX download is resumed
+DOWNLOAD_RETRIES = 3
+
+# HTTP timeout of GPX downloads (in seconds)
+DOWNLOAD_TIMEOUT = 60
+
+# Response headers saved to revalidate and resume GPX downloads
+DOWNLOAD_VALIDATORS = ("ETag", "Last-Modified")
+
 
 WATER_AMENITIES = {
     "water": "[amenity=drinking_water]",
@@ -44,251 +105,815 @@ FOOD_AMENITIES = {
 }
 
 
-def display_gpx_on_map(data, pois):
+# Waypoint type, amenities and waypoint details of each POI category.
+# Details are (default name, description, symbol), where a None name or
+# description is replaced by the POI name or its capitalized tag value.
+POI_CATEGORIES = [
+    ("TOILET", TOILET_AMENITIES, {
+        "toilets": ("Toilets", "Toilets", "restroom"),
+    }),
+    ("GEAR", REPAIR_AMENITIES, {
+        "workshop": ("Repair", "Bicycle repair station", "gear"),
+        "rental": ("Repair", "Bicycle repair station", "gear"),
+        "pump": ("Repair", "Bicycle repair station", "gear"),
+        "shop": ("Bike Shop", "Bicycle shop with repair service", "gear"),
+    }),
+    ("FOOD", FOOD_AMENITIES, {
+        "cafe": (None, None, "restaurant"),
+        "restaurant": (None, None, "restaurant"),
+        "fast_food": (None, None, "restaurant"),
+        "bakery": (None, None, "shopping"),
+        "supermarket": (None, None, "shopping"),
+        "convenience": (None, None, "shopping"),
+        "greengrocer": (None, None, "shopping"),
+    }),
+    ("WATER", WATER_AMENITIES, {
+        "water": ("Drinking Fountain", "Drinking water fountain", "water-drop"),
+        "point": ("Water Point", "Potable water point", "water-drop"),
+        "tap": ("Water Tap", "Potable water tap", "water-drop"),
+        "spring": ("Natural Spring", "Natural spring with potable water", "water-drop"),
+        "fountain": ("Potable Fountain", "Potable decorative fountain", "water-drop"),
+    }),
+]
+
+# Rules for POIs only matching part of an amenity tag filter
+POI_FALLBACKS = {
+    ("natural", "spring"): ("WATER", "Spring", "Natural spring (drinking quality unknown)", "water-drop"),
+    ("man_made", "water_tap"): ("WATER", "Water Tap", "Water tap (drinking quality unknown)", "water-drop"),
+}
+
+# Maximum length of waypoint names
+POI_NAME_LENGTH = 15
+
+# Tolerance of the track simplification of fast maps (in meters)
+MAP_TOLERANCE = 10
+
+# Decimals kept in the coordinates of fast maps (about a meter)
+MAP_PRECISION = 5
+
+# Map marker color and icon of each waypoint symbol
+MAP_ICONS = {
+    "restroom": ("purple", "home"),
+    "gear": ("green", "wrench"),
+    "restaurant": ("orange", "cutlery"),
+    "shopping": ("orange", "shopping-cart"),
+    "water-drop": ("blue", "info-sign"),
+}
+
+
+# Builds the markers of fast maps from [lat, lon, popup, color, icon] rows
+FAST_MARKER_CALLBACK = """
+function (row) {
+    var marker = L.marker(new L.LatLng(row[0], row[1]));
+    marker.setIcon(L.AwesomeMarkers.icon({markerColor: row[3], icon: row[4], prefix: "glyphicon"}));
+    marker.bindPopup(row[2], {maxWidth: 300});
+    return marker;
+};
+"""
+
+
+class PoiRule(typing.NamedTuple):
+    """
+    Classification rule of POIs matching all the tag conditions
+    """
+
+    conditions: tuple
+    type: str
+    name: str
+    description: str
+    symbol: str
+    priority: int = 0
+
+
+class Poi(typing.NamedTuple):
+    """
+    POI classified once, with all the details needed by the later stages
+    """
+
+    osm_type: str
+    id: int
+    lat: float
+    lon: float
+    tags: dict
+    type: str
+    name: str
+    symbol: str
+    description: str
+    km: float = None
+
+
+class Gap(typing.NamedTuple):
+    """
+    Stretch of the track between two consecutive POIs of a type
+    """
+
+    start_km: float
+    end_km: float
+    start: str
+    end: str
+
+    @property
+    def length_km(self):
+        return self.end_km - self.start_km
+
+
+def parse_tag_filter(tag_filter):
+    """
+    Return the (key, value) conditions of an Overpass tag filter such as "[amenity=fountain][drinking_water=yes]"
+    """
+
+    return tuple(tuple(condition.split("=", 1)) for condition in re.findall(r"\[([^\]]+)\]", tag_filter))
+
+
+def compile_poi_rules(categories=POI_CATEGORIES):
+    """
+    Return the classification rules indexed by the (key, value) of their first tag condition
+
+    Rules on the amenity key come first, followed by the others, each in the
+    order of the categories.
+    """
+
+    rules = []
+    for poi_type, amenities, details in categories:
+        for amenity, tag_filter in amenities.items():
+            name, description, symbol = details[amenity]
+            rules.append(PoiRule(parse_tag_filter(tag_filter), poi_type, name, description, symbol))
+
+    rules.sort(key=lambda rule: rule.conditions[0][0] != "amenity")
+
+    lookup = {}
+    for priority, rule in enumerate(rules):
+        lookup.setdefault(rule.conditions[0], []).append(rule._replace(priority=priority))
+    return lookup
+
+
+POI_RULES = compile_poi_rules()
+
+# Tags kept in the Overpass elements, those read by classify_poi
+POI_TAG_KEYS = frozenset({"name", *(key for key, _ in POI_FALLBACKS),
+                          *(key for rules in POI_RULES.values() for rule in rules for key, _ in rule.conditions)})
+
+
+def get_position(element):
+    """
+    Return the (lat, lon) of an Overpass element, the center of ways and relations, or None if it has none
+    """
+
+    position = element if "lat" in element else element.get("center")
+    if position is None:
+        return None
+    return position["lat"], position["lon"]
+
+
+def compact_element(element):
+    """
+    Return an Overpass element with a position as a compact record
+
+    Only its type, id, coordinates (the center of ways and relations) and
+    the tags of POI_TAG_KEYS are kept, dropping the node lists, members and
+    other tags. The POI database returns the same records.
+    """
+
+    lat, lon = get_position(element)
+    return {"type": element.get("type", "node"), "id": element.get("id"), "lat": lat, "lon": lon,
+            "tags": {key: value for key, value in element.get("tags", {}).items() if key in POI_TAG_KEYS}}
+
+
+def classify_poi(element):
+    """
+    Return the Poi of an Overpass element
+    """
+
+    tags = element.get("tags", {})
+
+    rule = None
+    for item in tags.items():
+        for candidate in POI_RULES.get(item, ()):
+            if all(tags.get(key) == value for key, value in candidate.conditions[1:]):
+                if rule is None or candidate.priority < rule.priority:
+                    rule = candidate
+                break
+
+    if rule is not None:
+        poi_type, name, description, symbol = rule.type, rule.name, rule.description, rule.symbol
+        value = tags[rule.conditions[0][0]].capitalize()
+        if name is None:
+            name = value
+        if description is None:
+            description = tags.get("name", value)
+    elif "shop" in tags:
+        poi_type, name, description, symbol = "WATER", "Unknown Shop", f"Shop: {tags['shop']}", "water-drop"
+    else:
+        fallback = next((POI_FALLBACKS[item] for item in tags.items() if item in POI_FALLBACKS), None)
+        if fallback is not None:
+            poi_type, name, description, symbol = fallback
+        else:
+            # Default for any other POI detected as water source
+            tag_summary = ", ".join(f"{k}={v}" for k, v in list(tags.items())[:2])
+            poi_type, name, description, symbol = "WATER", "Water Source", f"Water source: {tag_summary}", "water-drop"
+
+    # Use POI's original name if available
+    name = tags.get("name", name)[:POI_NAME_LENGTH]
+
+    lat, lon = get_position(element)
+    return Poi(element.get("type", "node"), element.get("id"), lat, lon, tags,
+               poi_type, name, symbol, description)
+
+
+def classify_pois(pois):
+    """
+    Return POIs as Poi records, classifying the Overpass elements
+
+    Elements without a position, such as ways and relations without a
+    center, are dropped.
+    """
+
+    return [poi if isinstance(poi, Poi) else classify_poi(poi) for poi in pois
+            if isinstance(poi, Poi) or get_position(poi) is not None]
+
+
+_session = None
+_session_pool_size = 0
+_session_lock = threading.Lock()
+
+
+class OfflineError(Exception):
+    """
+    Raised when data must be fetched from the network in offline mode
+    """
+
+
+class OverpassError(Exception):
+    """
+    Raised when Overpass reports a runtime error, with incomplete results
+    """
+
+
+def display_gpx_on_map(data, pois, fast=False, tolerance_m=MAP_TOLERANCE):
     """
     Display the GPX route and POIs on a map
+
+    The fast mode is meant for huge traces: the track is simplified to
+    tolerance_m and drawn as a single line with rounded coordinates, and the
+    POIs are sent as one data array, rendered as clustered markers by the
+    browser.
     """
 
+    # Imported here, as folium takes longer to import than the rest of thirsty
+    import folium
+    import folium.plugins
+
+    track = thirsty.track.as_track(data)
+    pois = classify_pois(pois)
+
     # Create a base map centered around the middle of the GPX track
-    track_latitudes = [ point.latitude
-                        for track in data.tracks
-                        for segment in track.segments
-                        for point in segment.points ]
+    map_center = [float(track.lat.mean()), float(track.lon.mean())]
+    folium_map = folium.Map(location=map_center, zoom_start=12)
 
-    track_longitudes = [ point.longitude
-                         for track in data.tracks
-                         for segment in track.segments
-                         for point in segment.points ]
+    if fast:
+        lines = [np.round(thirsty.geo.simplify_line(segment, tolerance_m), MAP_PRECISION).tolist()
+                 for segment in track.segments]
+        folium.PolyLine(lines, color="blue", weight=2.5, opacity=1).add_to(folium_map)
 
-    center_lat = sum(track_latitudes) / len(track_latitudes)
-    center_lon = sum(track_longitudes) / len(track_longitudes)
+        markers = [[round(poi.lat, MAP_PRECISION), round(poi.lon, MAP_PRECISION), html.escape(poi.description),
+                    *MAP_ICONS[poi.symbol]]
+                   for poi in pois]
+        folium.plugins.FastMarkerCluster(markers, callback=FAST_MARKER_CALLBACK).add_to(folium_map)
 
-    map_center = [center_lat, center_lon]
-    folium_map = folium.Map(location=map_center, zoom_start=12)
+        return folium_map
 
     # Plot the GPX track on the map
-    for track in data.tracks:
-        for segment in track.segments:
-            # Create a list of coordinates from the GPX track segment
-            track_coords = [(point.latitude, point.longitude) for point in segment.points]
-            folium.PolyLine(track_coords, color="blue", weight=2.5, opacity=1).add_to(folium_map)
+    for segment in track.segments:
+        folium.PolyLine(segment.tolist(), color="blue", weight=2.5, opacity=1).add_to(folium_map)
 
     # Plot POIs on the map
     for poi in pois:
-        icon_color = "blue"
-        icon_symbol = "info-sign"
-        popup_text = ""
-        
-        if "amenity" in poi["tags"]:
-            if poi["tags"]["amenity"] == "toilets":
-                icon_color = "purple"
-                icon_symbol = "home"
-                popup_text = "Toilets"
-            elif poi["tags"]["amenity"] == "bicycle_repair_station" or \
-                 poi["tags"]["amenity"] == "bicycle_rental" or \
-                 poi["tags"]["amenity"] == "compressed_air":
-                icon_color = "green"
-                icon_symbol = "wrench"
-                popup_text = "Bicycle Repair Station"
-            elif poi["tags"]["amenity"] in ["cafe", "restaurant", "fast_food"]:
-                icon_color = "orange"
-                icon_symbol = "cutlery"
-                popup_text = f"{poi['tags']['name'] if 'name' in poi['tags'] else poi['tags']['amenity'].capitalize()}"
-            else:
-                popup_text = f"{poi['tags']['amenity']}"
-        elif "shop" in poi["tags"]:
-            if poi["tags"]["shop"] == "bicycle":
-                icon_color = "green"
-                icon_symbol = "wrench"
-                popup_text = "Bicycle Shop with Repair"
-            elif poi["tags"]["shop"] in ["bakery", "supermarket", "convenience", "greengrocer"]:
-                icon_color = "orange"
-                icon_symbol = "shopping-cart"
-                popup_text = f"{poi['tags']['name'] if 'name' in poi['tags'] else poi['tags']['shop'].capitalize()}"
-                
+        icon_color, icon_symbol = MAP_ICONS[poi.symbol]
         folium.Marker(
-            location=[poi['lat'], poi['lon']],
-            popup=folium.Popup(popup_text, max_width=300),
+            location=[poi.lat, poi.lon],
+            popup=folium.Popup(poi.description, max_width=300),
             icon=folium.Icon(color=icon_color, icon=icon_symbol)
         ).add_to(folium_map)
 
     return folium_map
 
 
-def download_gpx(url):
+def download_gpx(url, cache=None, offline=False):
     """
-    Download GPX from URL
+    Download GPX from URL, and return it as a binary file object
+
+    The document is requested with gzip compression, and downloads
+    interrupted by network errors are resumed where they stopped with Range
+    requests, as long as the server sent an ETag or Last-Modified header.
+    Gzip-compressed documents are decompressed.
+
+    With a DownloadCache, the document is only downloaded again when the
+    server reports it changed since the cached one, downloads interrupted in
+    a previous run are resumed, and the cached file is returned, so that it
+    is read from disk instead of memory. With offline, the cached document
+    is used without revalidation.
     """
 
+    import requests
+    import urllib3.exceptions
+
+    cached = cache.get(url) if cache is not None else None
+
+    if offline:
+        if cached is None:
+            raise OfflineError(f"GPX download of {url} is not cached")
+        console.print(f"✅ Using cached GPX of {url}")
+        cache.touch(url)
+        return open(cached[0], "rb")  # noqa: SIM115
+
     console.print(f"⏳ Downloading GPX from {url}")
 
-    response = requests.get(url, stream=True)
-    response.raise_for_status()
+    request_headers = {"Accept-Encoding": "gzip"}
+    if cached is not None:
+        if "ETag" in cached[1]:
+            request_headers["If-None-Match"] = cached[1]["ETag"]
+        if "Last-Modified" in cached[1]:
+            request_headers["If-Modified-Since"] = cached[1]["Last-Modified"]
+
+    if cache is not None:
+        part = cache.path(url, cache.PART_SUFFIX)
+        headers = cache.headers(part) or {}
+        data = open(part, "ab+")  # noqa: SIM115
+        if not headers:
+            data.truncate(0)
+    else:
+        headers = {}
+        data = tempfile.TemporaryFile()  # noqa: SIM115
 
-    total_size = int(response.headers.get("Content-Length", 0))
+    try:
+        for attempt in range(DOWNLOAD_RETRIES + 1):
+            try:
+                modified = _download(url, data, request_headers, headers, cache)
+                break
+            except (requests.ConnectionError, requests.Timeout,
+                    urllib3.exceptions.ProtocolError, urllib3.exceptions.ReadTimeoutError) as e:
+                if attempt == DOWNLOAD_RETRIES:
+                    if cached is None:
+                        raise
+                    console.print(f"⚠️  Cannot revalidate the GPX download ({e}), using the cached one")
+                    data.close()
+                    cache.discard_partial(url, empty_only=True)
+                    cache.touch(url)
+                    return open(cached[0], "rb")  # noqa: SIM115
+                delay = retry_delay(None, attempt)
+                console.print(f"⚠️  GPX download failed ({e}), resuming in {delay:.0f}s")
+                time.sleep(delay)
 
-    data = io.BytesIO()
+        if not modified:
+            data.close()
+            # A partial download of another version of the document is of no use
+            cache.discard_partial(url)
+            console.print(f"✅ Cached GPX of {url} is up to date")
+            cache.touch(url)
+            return open(cached[0], "rb")  # noqa: SIM115
+
+        if cache is not None:
+            data.close()
+            return open(cache.commit(url, headers), "rb")  # noqa: SIM115
+
+        if thirsty.cache.is_gzip(data):
+            compressed, data = data, tempfile.TemporaryFile()  # noqa: SIM115
+            with compressed:
+                thirsty.cache.decompress(compressed, data)
+        data.seek(0)
+        return data
+    except BaseException:
+        data.close()
+        if cache is not None:
+            # Keep the bytes already downloaded, to resume them in a later run
+            cache.discard_partial(url, empty_only=True)
+        raise
+
+
+def _download(url, data, request_headers, headers, cache=None):
+    """
+    Download url to the end of the binary file data, resuming it after the bytes already written
+
+    headers: response headers of the bytes already written, updated with
+    those of the response, and saved to the partial download of the cache
+
+    Return whether the document was downloaded, False when the server
+    replied it was not modified.
+    """
 
-    with rich.progress.Progress() as progress:
-        task = progress.add_task("[cyan] Downloading", total=total_size)
+    request_headers = dict(request_headers)
+    offset = data.seek(0, io.SEEK_END)
+    validator = headers.get("ETag") or headers.get("Last-Modified")
+    if offset and validator:
+        request_headers["Range"] = f"bytes={offset}-"
+        request_headers["If-Range"] = validator
 
-        for chunk in response.iter_content(chunk_size=1024):
-            data.write(chunk)
-            progress.update(task, advance=len(chunk))
+    thirsty.metrics.count("http_requests")
+    response = get_session().get(url, headers=request_headers, stream=True, timeout=DOWNLOAD_TIMEOUT)
+
+    with response:
+        if response.status_code == 304:
+            return False
+        response.raise_for_status()
+
+        if response.status_code != 206:
+            # Not resumed, start over
+            offset = 0
+            data.seek(0)
+            data.truncate()
+            headers.clear()
+        headers.update({name: response.headers[name] for name in DOWNLOAD_VALIDATORS if name in response.headers})
+        if cache is not None:
+            cache.set_partial_headers(url, headers)
+
+        total_size = int(response.headers.get("Content-Length", 0))
+
+        with rich.progress.Progress() as progress:
+            task = progress.add_task("[cyan] Downloading", total=offset + total_size if total_size else None,
+                                     completed=offset)
+
+            # Raw chunks, so that the Range offsets are those of the compressed document
+            for chunk in response.raw.stream(DOWNLOAD_CHUNK_SIZE, decode_content=False):
+                data.write(chunk)
+                progress.update(task, advance=len(chunk))
+                thirsty.metrics.count("http_bytes_received", len(chunk))
+
+    return True
+
+
+def get_session(pool_size=OVERPASS_PARALLELISM):
+    """
+    Return the HTTP session shared by all requests, keeping connections alive
+
+    Its connection pools keep at least pool_size connections alive per
+    host, for as many concurrent requests, and are enlarged when a larger
+    size is asked for.
+    """
+
+    global _session, _session_pool_size
+
+    import requests
+    import requests.adapters
+
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+        if pool_size > _session_pool_size:
+            _session_pool_size = max(pool_size, HTTP_POOL_SIZE)
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=_session_pool_size)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+def retry_delay(response, attempt):
+    """
+    Return how long to wait before retrying a failed request
+
+    The Retry-After header is honored when present, otherwise the delay grows
+    exponentially with the attempt number, with some jitter.
+    """
+
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                delay = None
+        if delay is not None:
+            return min(max(delay, 0), OVERPASS_MAX_DELAY)
+
+    return min(OVERPASS_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5), OVERPASS_MAX_DELAY)
+
+
+def post_overpass(query, urls=None, retries=OVERPASS_RETRIES):
+    """
+    Run an Overpass query and return its elements
+
+    Rate limited (429), unavailable (5xx) and unreachable instances are
+    retried, moving on to the next instance of urls each time, as well as
+    responses with a runtime error remark, whose results are incomplete.
+    Once all the instances failed, the next round waits for an increasing
+    delay.
+    """
+
+    import requests
+
+    if not urls:
+        urls = OVERPASS_URLS
+
+    for attempt in range(retries + 1):
+        url = urls[attempt % len(urls)]
+        response = None
+
+        try:
+            thirsty.metrics.count("http_requests")
+            thirsty.metrics.count("http_bytes_sent", len(query.encode()))
+            response = get_session().post(url, data=query, timeout=OVERPASS_TIMEOUT)
+            thirsty.metrics.count("http_bytes_received", len(response.content))
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+            reason = type(e).__name__
+        else:
+            if response.status_code != 429 and response.status_code < 500:
+                response.raise_for_status()
+                data = response.json()
+                # Runtime errors, such as timeouts, come with partial results
+                if "remark" not in data:
+                    return [compact_element(element) for element in data["elements"]
+                            if get_position(element) is not None]
+                error = OverpassError(f"Overpass query failed on {url}: {data['remark']}")
+                reason = data["remark"]
+            else:
+                error = requests.HTTPError(f"{response.status_code} {response.reason}", response=response)
+                reason = f"HTTP {response.status_code}"
+
+        if attempt == retries:
+            raise error
+
+        if (attempt + 1) % len(urls):
+            console.print(f"⚠️  Overpass query failed on {url} ({reason}), trying next instance")
+            continue
+
+        delay = retry_delay(response, attempt // len(urls))
+        console.print(f"⚠️  Overpass query failed on {url} ({reason}), retrying in {delay:.0f}s")
+        time.sleep(delay)
 
-    data.seek(0)
-    return data
 
 def get_bounds(gpx):
     """
     Return GPX trace bounding box [south, west, north, est]
     """
 
-    min_lat = min(pt.latitude for trk in gpx.tracks for seg in trk.segments for pt in seg.points)
-    max_lat = max(pt.latitude for trk in gpx.tracks for seg in trk.segments for pt in seg.points)
-    min_lon = min(pt.longitude for trk in gpx.tracks for seg in trk.segments for pt in seg.points)
-    max_lon = max(pt.longitude for trk in gpx.tracks for seg in trk.segments for pt in seg.points)
-    return min_lat, min_lon, max_lat, max_lon
+    track = thirsty.track.as_track(gpx)
+    return float(track.lat.min()), float(track.lon.min()), float(track.lat.max()), float(track.lon.max())
 
 
-def query_overpass(bbox, water_types=None, toilet_types=None, repair_types=None, food_types=None):
+def get_segments(gpx):
     """
-    Generate an Overpass QL query for potable drinking water POIs, toilets, bicycle repair stations, and food amenities.
+    Return GPX track segments as (n, 2) arrays of (lat, lon)
     """
 
+    return thirsty.track.as_track(gpx).segments
+
+
+def get_corridor_tiles(gpx, buffer_m, tile_size=CORRIDOR_TILE_SIZE):
+    """
+    Return the tiles covering the GPX trace, as (key, bbox, segments) tuples
+
+    Each line between two consecutive track points belongs to the tile of a
+    fixed grid (with tile_size degrees cells) where it starts. The segments
+    of a tile are the runs of consecutive track points of its lines, as (n, 2)
+    arrays, and its bounding box [south, west, north, est] covers them
+    extended by buffer_m on every side. The key is the (row, column) of the
+    tile in the grid. Tiles are returned in the order the trace goes through
+    them.
+    """
+
+    tiles = {}
+    for coords in get_segments(gpx):
+        if len(coords) == 0:
+            continue
+
+        cells = np.floor(coords[:max(len(coords) - 1, 1)] / tile_size).astype(np.int64)
+
+        # Split the segment where its lines move to another tile
+        breaks = np.flatnonzero(np.any(cells[1:] != cells[:-1], axis=1)) + 1
+        for first, last in zip([0, *breaks], [*breaks, len(cells)]):
+            key = tuple(int(v) for v in cells[first])
+            tiles.setdefault(key, []).append(coords[first:last + 1])
+
+    result = []
+    lat_buffer = math.degrees(buffer_m / thirsty.geo.EARTH_RADIUS)
+    for key, segments in tiles.items():
+        points = np.concatenate(segments)
+        (south, west), (north, east) = points.min(axis=0), points.max(axis=0)
+        lon_buffer = lat_buffer / max(math.cos(math.radians(max(abs(south), abs(north)) + lat_buffer)), 1e-6)
+        bbox = (max(south - lat_buffer, -90), max(west - lon_buffer, -180),
+                min(north + lat_buffer, 90), min(east + lon_buffer, 180))
+        result.append((key, bbox, segments))
+
+    return result
+
+
+def get_corridor_bounds(gpx, buffer_m, tile_size=CORRIDOR_TILE_SIZE):
+    """
+    Return bounding boxes [south, west, north, est] of the tiles covering the GPX trace
+
+    See get_corridor_tiles.
+    """
+
+    return [bbox for _, bbox, _ in get_corridor_tiles(gpx, buffer_m, tile_size)]
+
+
+def merge_elements(*element_lists):
+    """
+    Merge lists of Overpass elements, dropping duplicates by OSM type and id
+    """
+
+    seen = set()
+    merged = []
+    for elements in element_lists:
+        for element in elements:
+            key = (element["type"], element["id"])
+            if key not in seen:
+                seen.add(key)
+                merged.append(element)
+    return merged
+
+
+def round_bbox(bbox):
+    """
+    Return a (south, west, north, east) bounding box rounded outwards to BBOX_PRECISION decimals
+    """
+
+    scale = 10 ** BBOX_PRECISION
     south, west, north, east = bbox
-    bbox_str = f"({south},{west},{north},{east})"
+    south, west = (math.floor(v * scale) / scale for v in (south, west))
+    north, east = (math.ceil(v * scale) / scale for v in (north, east))
+    return south, west, north, east
+
+
+def get_tag_filters(water_types=None, toilet_types=None, repair_types=None, food_types=None):
+    """
+    Return the sorted Overpass tag filters of the selected POI types
+    """
+
+    tag_filters = set()
 
-    query_parts = []
-    
     if water_types:
         for poi_type in water_types:
-            tag_filter = WATER_AMENITIES[poi_type]
-            # for osm_type in ["node", "way", "relation"]:
-            #     query_parts.append(f'{osm_type}{tag_filter}{bbox_str};')
-            query_parts.append(f'node{tag_filter}{bbox_str};')
-            
+            tag_filters.add(WATER_AMENITIES[poi_type])
+
     if toilet_types:
         for poi_type in toilet_types:
-            tag_filter = TOILET_AMENITIES[poi_type]
-            query_parts.append(f'node{tag_filter}{bbox_str};')
-            
+            tag_filters.add(TOILET_AMENITIES[poi_type])
+
     if repair_types:
         for poi_type in repair_types:
-            tag_filter = REPAIR_AMENITIES[poi_type]
-            query_parts.append(f'node{tag_filter}{bbox_str};')
-            
+            tag_filters.add(REPAIR_AMENITIES[poi_type])
+
     if food_types:
         for poi_type in food_types:
-            tag_filter = FOOD_AMENITIES[poi_type]
-            query_parts.append(f'node{tag_filter}{bbox_str};')
+            tag_filters.add(FOOD_AMENITIES[poi_type])
+
+    return sorted(tag_filters)
+
+
+def build_overpass_query(bbox, water_types=None, toilet_types=None, repair_types=None, food_types=None,
+                         ways=False):
+    """
+    Generate an Overpass QL query for potable drinking water POIs, toilets, bicycle repair stations, and food amenities.
+
+    The query is normalized so that the same selection over nearby bounding
+    boxes gives the same query: the bounding box is rounded outwards to
+    BBOX_PRECISION decimals and the filters are sorted.
+
+    With ways, POIs mapped as ways and relations are queried too, and only
+    their tags and center are output, without their nodes or members. All
+    their tags are output, those outside POI_TAG_KEYS are only dropped
+    once downloaded.
+    """
+
+    south, west, north, east = round_bbox(bbox)
+    bbox_str = f"({south:.{BBOX_PRECISION}f},{west:.{BBOX_PRECISION}f},{north:.{BBOX_PRECISION}f},{east:.{BBOX_PRECISION}f})"
+
+    tag_filters = get_tag_filters(water_types, toilet_types, repair_types, food_types)
+
+    query_parts = [f'node{tag_filter}{bbox_str};' for tag_filter in tag_filters]
+
+    if not ways:
+        return "[out:json][timeout:25];(" + "".join(query_parts) + ");out center;"
 
-    query = "[out:json][timeout:25];(" + "".join(query_parts) + ");out center;"
-    response = requests.post(OVERPASS_URL, data=query)
-    response.raise_for_status()
-    return response.json()["elements"]
+    area_parts = [f'{osm_type}{tag_filter}{bbox_str};' for tag_filter in tag_filters for osm_type in OSM_TYPES[1:]]
 
+    return ("[out:json][timeout:25];(" + "".join(query_parts) + ");out;("
+            + "".join(area_parts) + ");out tags center;")
 
-def add_waypoints_to_gpx(gpx, pois):
+
+def query_overpass(bbox, water_types=None, toilet_types=None, repair_types=None, food_types=None,
+                   cache=None, offline=False, urls=None, poi_db=None, ttl=None, category_ttls=None, ways=False):
+    """
+    Query Overpass for potable drinking water POIs, toilets, bicycle repair stations, and food amenities.
+
+    Responses are looked up in, and stored to, the optional thirsty.cache.Cache,
+    and refreshed once older than ttl (default: the TTL of the cache).
+    In offline mode, a query missing from the cache raises OfflineError.
+    When a local thirsty.poidb.PoiDatabase is given, it answers the query
+    instead of Overpass, and the cache is not used. With ways, POIs mapped
+    as ways and relations are queried too, at their center (the POI
+    database only holds nodes).
+
+    With category_ttls, a dict of TTLs by category of QUERY_CATEGORIES (it
+    may be empty), each selected category is queried and cached on its own,
+    so that only the categories older than their TTL are fetched again, and
+    the elements are merged by OSM id.
+    """
+
+    if poi_db is not None:
+        return poi_db.query(round_bbox(bbox), get_tag_filters(water_types, toilet_types, repair_types, food_types))
+
+    if category_ttls is not None:
+        selection = dict(zip(QUERY_CATEGORIES, (water_types, toilet_types, repair_types, food_types)))
+        elements = merge_elements(*(query_overpass(bbox, **{f"{category}_types": types}, cache=cache,
+                                                   offline=offline, urls=urls, ttl=category_ttls.get(category, ttl),
+                                                   ways=ways)
+                                    for category, types in selection.items() if types))
+        # In the order of the response to the query of all the categories
+        return sorted(elements, key=lambda element: (OSM_TYPES.index(element["type"]), element["id"]))
+
+    query = build_overpass_query(bbox, water_types, toilet_types, repair_types, food_types, ways=ways)
+
+    if cache is not None:
+        elements = cache.get(query, ttl=ttl)
+        if elements is not None:
+            thirsty.metrics.count("cache_hits")
+            return elements
+        thirsty.metrics.count("cache_misses")
+
+    if offline:
+        raise OfflineError("Overpass response not in cache, cannot query it offline")
+
+    elements = post_overpass(query, urls)
+
+    if cache is not None:
+        cache.set(query, elements)
+
+    return elements
+
+
+def query_overpass_tiles(bboxes, water_types=None, toilet_types=None, repair_types=None, food_types=None,
+                         cache=None, offline=False, urls=None, parallelism=OVERPASS_PARALLELISM, poi_db=None,
+                         progress=True, category_ttls=None, ways=False):
+    """
+    Query Overpass over each bounding box, and return the list of elements of each one
+
+    Up to parallelism queries run concurrently. A progress bar is displayed
+    if progress is true. See query_overpass for category_ttls and ways.
+    """
+
+    # Keep a connection alive for each concurrent query
+    get_session(parallelism)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(parallelism, 1)) as executor:
+        futures = [executor.submit(query_overpass, bbox, water_types, toilet_types, repair_types, food_types,
+                                   cache=cache, offline=offline, urls=urls, poi_db=poi_db,
+                                   category_ttls=category_ttls, ways=ways)
+                   for bbox in bboxes]
+
+        if progress:
+            with rich.progress.Progress() as bar:
+                task = bar.add_task("Querying Overpass", total=len(futures))
+                for _ in concurrent.futures.as_completed(futures):
+                    bar.advance(task)
+
+        return [future.result() for future in futures]
+
+
+def query_overpass_corridor(bboxes, water_types=None, toilet_types=None, repair_types=None, food_types=None,
+                            cache=None, offline=False, urls=None, parallelism=OVERPASS_PARALLELISM, poi_db=None,
+                            progress=True, category_ttls=None, ways=False):
+    """
+    Query Overpass over each bounding box of a corridor, and merge the results by OSM id
+
+    Up to parallelism queries run concurrently. A progress bar is displayed
+    if progress is true. See query_overpass for category_ttls and ways.
+    """
+
+    return merge_elements(*query_overpass_tiles(bboxes, water_types, toilet_types, repair_types, food_types,
+                                                cache=cache, offline=offline, urls=urls, parallelism=parallelism,
+                                                poi_db=poi_db, progress=progress, category_ttls=category_ttls,
+                                                ways=ways))
+
+
+def add_waypoints_to_gpx(gpx, pois, km=False):
     """
     Add POI to GPX trace
+
+    With km, waypoints are sorted along the track, and their along-track
+    distance is added to their description.
     """
 
+    import gpxpy.gpx
+
+    pois = classify_pois(pois)
+    if km:
+        pois = sorted(pois, key=lambda poi: math.inf if poi.km is None else poi.km)
+
     for poi in pois:
         wpt = gpxpy.gpx.GPXWaypoint()
-        wpt.latitude = poi["lat"]
-        wpt.longitude = poi["lon"]
-        
-        # Helper function to create POI name (limited to 15 chars)
-        def create_poi_name(default_name):
-            if "name" in poi["tags"]:
-                # Use POI's original name if available, truncated to 15 chars
-                return poi["tags"]["name"][:15]
-            return default_name[:15]  # Default name truncated to 15 chars
-        
-        # Determine POI type based on tags
-        if "amenity" in poi["tags"]:
-            if poi["tags"]["amenity"] == "toilets":
-                wpt.name = create_poi_name("Toilets")
-                wpt.description = "Toilets"
-                wpt.symbol = "restroom"
-                wpt.type = "TOILET"
-            elif poi["tags"]["amenity"] == "bicycle_repair_station" or \
-                 poi["tags"]["amenity"] == "bicycle_rental" or \
-                 poi["tags"]["amenity"] == "compressed_air":
-                wpt.name = create_poi_name("Repair")
-                wpt.description = "Bicycle repair station"
-                wpt.symbol = "gear"
-                wpt.type = "GEAR"
-            elif poi["tags"]["amenity"] in ["cafe", "restaurant", "fast_food"]:
-                wpt.name = create_poi_name(poi["tags"]["amenity"].capitalize())
-                wpt.description = poi["tags"]["name"] if "name" in poi["tags"] else poi["tags"]["amenity"].capitalize()
-                wpt.symbol = "restaurant"
-                wpt.type = "FOOD"
-            elif poi["tags"]["amenity"] == "drinking_water":
-                wpt.name = create_poi_name("Drinking Fountain")
-                wpt.description = "Drinking water fountain"
-                wpt.symbol = "water-drop"
-                wpt.type = "WATER"
-            elif poi["tags"]["amenity"] == "water_point" and poi["tags"].get("drinking_water") == "yes":
-                wpt.name = create_poi_name("Water Point")
-                wpt.description = "Potable water point"
-                wpt.symbol = "water-drop"
-                wpt.type = "WATER"
-            elif poi["tags"]["amenity"] == "fountain" and poi["tags"].get("drinking_water") == "yes":
-                wpt.name = create_poi_name("Potable Fountain")
-                wpt.description = "Potable decorative fountain"
-                wpt.symbol = "water-drop"
-                wpt.type = "WATER"
-            elif "man_made" in poi["tags"] and poi["tags"]["man_made"] == "water_tap" and poi["tags"].get("drinking_water") == "yes":
-                wpt.name = create_poi_name("Water Tap")
-                wpt.description = "Potable water tap"
-                wpt.symbol = "water-drop"
-                wpt.type = "WATER"
-            elif "natural" in poi["tags"] and poi["tags"]["natural"] == "spring" and poi["tags"].get("drinking_water") == "yes":
-                wpt.name = create_poi_name("Natural Spring")
-                wpt.description = "Natural spring with potable water"
-                wpt.symbol = "water-drop"
-                wpt.type = "WATER"
-        elif "shop" in poi["tags"]:
-            if poi["tags"]["shop"] == "bicycle":
-                wpt.name = create_poi_name("Bike Shop")
-                wpt.description = "Bicycle shop with repair service"
-                wpt.symbol = "gear"
-                wpt.type = "GEAR"
-            elif poi["tags"]["shop"] in ["bakery", "supermarket", "convenience", "greengrocer"]:
-                wpt.name = create_poi_name(poi["tags"]["shop"].capitalize())
-                wpt.description = poi["tags"]["name"] if "name" in poi["tags"] else poi["tags"]["shop"].capitalize()
-                wpt.symbol = "shopping"
-                wpt.type = "FOOD"
-            else:
-                # Unknown shop type
-                wpt.name = create_poi_name("Unknown Shop")
-                wpt.description = f"Shop: {poi['tags']['shop']}"
-                wpt.symbol = "water-drop"
-                wpt.type = "WATER"
-        elif "natural" in poi["tags"] and poi["tags"]["natural"] == "spring":
-            # Natural spring without explicit drinking_water tag
-            wpt.name = create_poi_name("Spring")
-            wpt.description = "Natural spring (drinking quality unknown)"
-            wpt.symbol = "water-drop"
-            wpt.type = "WATER"
-        elif "man_made" in poi["tags"] and poi["tags"]["man_made"] == "water_tap":
-            # Water tap without explicit drinking_water tag
-            wpt.name = create_poi_name("Water Tap")
-            wpt.description = "Water tap (drinking quality unknown)"
-            wpt.symbol = "water-drop"
-            wpt.type = "WATER"
-        else:
-            # Default for any other POI detected as water source
-            tag_keys = list(poi["tags"].keys())
-            tag_summary = ", ".join([f"{k}={poi['tags'][k]}" for k in tag_keys[:2]])
-            
-            wpt.name = create_poi_name("Water Source")
-            wpt.description = f"Water source: {tag_summary}"
-            wpt.symbol = "water-drop"
-            wpt.type = "WATER"
-            
+        wpt.latitude = poi.lat
+        wpt.longitude = poi.lon
+        wpt.name = poi.name
+        wpt.description = poi.description
+        if km and poi.km is not None:
+            wpt.description = f"km {poi.km:.1f}: {poi.description}"
+        wpt.symbol = poi.symbol
+        wpt.type = poi.type
         gpx.waypoints.append(wpt)
 
     return gpx
@@ -311,50 +936,104 @@ def haversine(lat1, lon1, lat2, lon2):
     return R * c
 
 
-def filter_pois_near_track(gpx, pois, max_distance_m=100, type_distances=None):
+def filter_pois_near_track(gpx, pois, max_distance_m=100, type_distances=None, progress=True, index=None, jobs=1):
     """
     Keep only POI near trace, with optional distances per POI type
-    
+
+    Kept POIs get their along-track distance (km), measured at the closest
+    position of the track.
+
     Parameters:
-    - gpx: GPX object with the track
+    - gpx: Track, or GPX object, with the track
     - pois: List of POIs to filter
     - max_distance_m: Default maximum distance in meters
     - type_distances: Dictionary mapping POI types to specific distances
       e.g. {'WATER': 200, 'TOILET': 100, 'GEAR': 300, 'FOOD': 150}
+    - progress: Whether to display a progress bar
+    - index: TrackIndex of the track, built with at least the largest
+      distance, to reuse it across calls
+    - jobs: Number of worker processes measuring the POIs, when there are
+      more than a batch of them
     """
     if type_distances is None:
         type_distances = {}
         
-    points = [pt for trk in gpx.tracks for seg in trk.segments for pt in seg.points]
-    nearby_pois = []
+    if index is None:
+        index = thirsty.geo.TrackIndex(get_segments(gpx), max([max_distance_m, *type_distances.values()]))
 
-    for poi in rich.progress.track(pois, description="Filtering POI"):
-        lat, lon = poi["lat"], poi["lon"]
-        
-        # Determine the POI type for distance filtering
-        poi_type = "WATER"  # Default type
-        if "amenity" in poi["tags"]:
-            if poi["tags"]["amenity"] == "toilets":
-                poi_type = "TOILET"
-            elif poi["tags"]["amenity"] == "bicycle_repair_station" or \
-                 poi["tags"]["amenity"] == "bicycle_rental" or \
-                 poi["tags"]["amenity"] == "compressed_air":
-                poi_type = "GEAR"
-            elif poi["tags"]["amenity"] in ["cafe", "restaurant", "fast_food"]:
-                poi_type = "FOOD"
-        elif "shop" in poi["tags"]:
-            if poi["tags"]["shop"] == "bicycle":
-                poi_type = "GEAR"
-            elif poi["tags"]["shop"] in ["bakery", "supermarket", "convenience", "greengrocer"]:
-                poi_type = "FOOD"
-                
-        # Use type-specific distance if available, otherwise fall back to default
-        distance = type_distances.get(poi_type, max_distance_m)
-        
-        if any(haversine(lat, lon, pt.latitude, pt.longitude) < distance for pt in points):
-            nearby_pois.append(poi)
+    pois = classify_pois(pois)
+
+    # Use type-specific distance if available, otherwise fall back to default
+    radii = np.array([type_distances.get(poi.type, max_distance_m) for poi in pois], dtype=float)
+    coords = thirsty.geo.to_unit_vectors([poi.lat for poi in pois], [poi.lon for poi in pois]).reshape(-1, 3)
+
+    if jobs > 1 and len(pois) > FILTER_BATCH_SIZE:
+        distances, along = thirsty.parallel.locate(index, coords, jobs, FILTER_BATCH_SIZE, progress=progress)
+        return [poi._replace(km=float(position) / 1000)
+                for poi, keep, position in zip(pois, distances < radii, along) if keep]
+
+    near = np.zeros(len(pois), dtype=bool)
+    along = np.full(len(pois), np.nan)
+
+    # Measure POIs by batches against the track segments
+    batches = range(0, len(pois), FILTER_BATCH_SIZE)
+    if progress:
+        batches = rich.progress.track(batches, description="Filtering POI")
+
+    for start in batches:
+        stop = start + FILTER_BATCH_SIZE
+        distances, along[start:stop] = index.locate(coords[start:stop])
+        near[start:stop] = distances < radii[start:stop]
+
+    return [poi._replace(km=float(position) / 1000) for poi, keep, position in zip(pois, near, along) if keep]
+
+
+def locate_pois(gpx, pois, max_distance_m=100):
+    """
+    Return the POIs with their along-track distance (km) on the whole GPX trace
+
+    Used when POIs were filtered against parts of the trace only: they must
+    be within max_distance_m of the trace, the others get no distance.
+    """
+
+    pois = classify_pois(pois)
+
+    index = thirsty.geo.TrackIndex(get_segments(gpx), max_distance_m)
+    coords = thirsty.geo.to_unit_vectors([poi.lat for poi in pois], [poi.lon for poi in pois]).reshape(-1, 3)
+    _, along = index.locate(coords)
+
+    return [poi._replace(km=None if np.isnan(position) else float(position) / 1000)
+            for poi, position in zip(pois, along)]
+
+
+def track_length(gpx):
+    """
+    Return the length in meter of the GPX trace, without the gaps between its segments
+    """
+
+    length = 0.0
+    for coords in get_segments(gpx):
+        vectors = thirsty.geo.to_unit_vectors(coords[:, 0], coords[:, 1])
+        length += float(thirsty.geo.arc_length(vectors[:-1], vectors[1:]).sum())
+    return length
+
+
+def find_gaps(pois, length_m, poi_type="WATER"):
+    """
+    Return the stretches of the track between consecutive POIs of a type, longest first
+
+    The stretches from the start of the track to the first POI, and from the
+    last POI to the end of the track are included. POIs must have their
+    along-track distance, see filter_pois_near_track.
+    """
+
+    located = sorted((poi for poi in classify_pois(pois) if poi.type == poi_type and poi.km is not None),
+                     key=lambda poi: poi.km)
+    marks = [(0.0, "Start"), *((poi.km, poi.name) for poi in located), (length_m / 1000, "Finish")]
 
-    return nearby_pois
+    gaps = [Gap(start_km, end_km, start, end)
+            for (start_km, start), (end_km, end) in zip(marks[:-1], marks[1:])]
+    return sorted(gaps, key=lambda gap: gap.length_km, reverse=True)
 
 
 def sanitize_gpx_text(data):
@@ -0,0 +1,352 @@
+import numpy as np
+
+EARTH_RADIUS = 6371000 # Earth radius in meter
+
+# Offsets of the 27 grid cells surrounding (and including) a cell
+NEIGHBOUR_CELLS = np.array([(dx, dy, dz)
+                            for dx in (-1, 0, 1)
+                            for dy in (-1, 0, 1)
+                            for dz in (-1, 0, 1)])
+
+# Number of (point, segment) pairs measured at once by TrackIndex.locate,
+# each taking a few hundred bytes of temporaries
+LOCATE_PAIR_BUDGET = 1 << 17
+
+
+def to_unit_vectors(lat, lon):
+    """
+    Convert latitudes and longitudes in degrees to unit vectors on the sphere
+    """
+
+    phi = np.radians(np.asarray(lat, dtype=float))
+    lam = np.radians(np.asarray(lon, dtype=float))
+    cos_phi = np.cos(phi)
+    return np.stack((cos_phi * np.cos(lam), cos_phi * np.sin(lam), np.sin(phi)), axis=-1)
+
+
+def chord_length(distance_m):
+    """
+    Return the chord length on the unit sphere matching a great-circle distance in meter
+    """
+
+    return 2 * np.sin(np.clip(distance_m / (2 * EARTH_RADIUS), 0, np.pi / 2))
+
+
+def arc_length(starts, ends):
+    """
+    Return the great-circle distance in meter between two arrays of unit vectors
+    """
+
+    return EARTH_RADIUS * 2 * np.arcsin(np.minimum(np.linalg.norm(ends - starts, axis=-1) / 2, 1))
+
+
+def _segment_geometry(points, starts, ends):
+    to_start = np.linalg.norm(points - starts, axis=1)
+    to_end = np.linalg.norm(points - ends, axis=1)
+
+    # Distance to the closest end, used when the projection of the point on
+    # the great circle falls outside of the arc
+    angles = 2 * np.arcsin(np.minimum(np.minimum(to_start, to_end) / 2, 1))
+
+    normals = np.cross(starts, ends)
+    norms = np.linalg.norm(normals, axis=1)
+    valid = norms > 1e-15
+    normals[valid] /= norms[valid, None]
+
+    start_cross = np.cross(starts, points)
+    inside = valid & \
+        (np.einsum("ij,ij->i", start_cross, normals) >= 0) & \
+        (np.einsum("ij,ij->i", np.cross(points, ends), normals) >= 0)
+
+    cross_track = np.arcsin(np.minimum(np.abs(np.einsum("ij,ij->i", points, normals)), 1))
+
+    distances = EARTH_RADIUS * np.where(inside, cross_track, angles)
+    return distances, inside, valid, normals, norms, start_cross, to_end < to_start
+
+
+def segment_distance(points, starts, ends):
+    """
+    Return the great-circle distance in meter between points and segments
+
+    All arguments are (n, 3) arrays of unit vectors: the distance is computed
+    between points[i] and the arc going from starts[i] to ends[i].
+    """
+
+    return _segment_geometry(points, starts, ends)[0]
+
+
+def segment_projection(points, starts, ends):
+    """
+    Return the great-circle distance in meter between points and segments,
+    and the position of the closest point of each segment, as a fraction of
+    its length
+
+    See segment_distance.
+    """
+
+    distances, inside, valid, normals, norms, start_cross, end_closer = _segment_geometry(points, starts, ends)
+
+    # Angle from the start to the projection of the point, over the arc angle
+    along = np.arctan2(np.einsum("ij,ij->i", start_cross, normals), np.einsum("ij,ij->i", starts, points))
+    arc = np.arctan2(norms, np.einsum("ij,ij->i", starts, ends))
+    fractions = np.where(inside, np.clip(np.divide(along, arc, out=np.zeros(len(arc)), where=valid), 0, 1),
+                         np.where(valid & end_closer, 1.0, 0.0))
+
+    return distances, fractions
+
+
+class TrackIndex:
+    """
+    Grid index of the track segments, used to measure the distance between
+    POIs and the track without scanning the whole track
+
+    Segments are registered in every cubic cell of a grid on the unit sphere
+    they go through. As the cell side is at least the chord length of the
+    search radius, every segment closer than the radius to a POI goes through
+    one of the 27 cells surrounding the POI cell.
+    """
+
+    # Array attributes of an index, enough to rebuild it with from_arrays
+    ARRAYS = ("starts", "ends", "lengths", "positions", "origin", "shape", "keys", "segment_ids")
+
+    def __init__(self, segments, radius_m):
+        """
+        segments: sequence of track segments, each a sequence of (lat, lon)
+        radius_m: largest distance which will be looked up
+        """
+
+        starts, ends = [], []
+        for segment in segments:
+            coords = np.asarray(segment, dtype=float).reshape(-1, 2)
+            if len(coords) == 0:
+                continue
+            vectors = to_unit_vectors(coords[:, 0], coords[:, 1])
+            if len(vectors) == 1:
+                # Lone point, kept as a zero-length segment
+                starts.append(vectors)
+                ends.append(vectors)
+            else:
+                starts.append(vectors[:-1])
+                ends.append(vectors[1:])
+
+        self.starts = np.concatenate(starts) if starts else np.empty((0, 3))
+        self.ends = np.concatenate(ends) if ends else np.empty((0, 3))
+
+        # Along-track distance at the start of each segment, the gaps between
+        # track segments are not counted
+        self.lengths = arc_length(self.starts, self.ends)
+        self.positions = np.cumsum(self.lengths) - self.lengths
+        self.length = float(self.lengths.sum())
+
+        chords = np.linalg.norm(self.ends - self.starts, axis=1)
+
+        # Cells smaller than the typical segment would only register each
+        # segment many times, without reducing the candidates much
+        cell_size = max(chord_length(radius_m), np.median(chords) if len(chords) else 0)
+        # Small margin so rounding errors never push a segment out of reach
+        self.cell_size = cell_size * (1 + 1e-9) + 1e-12
+
+        # Keep the cell numbers within 64-bit integers on huge tracks
+        if len(chords):
+            extent = np.ptp(np.concatenate((self.starts, self.ends)), axis=0)
+            while np.prod(extent / self.cell_size + 4) > 2 ** 62:
+                self.cell_size *= 2
+
+        self._build(chords)
+
+    def arrays(self):
+        """
+        Return the arrays of the index by name, to share them with other processes
+        """
+
+        return {name: getattr(self, name) for name in self.ARRAYS}
+
+    @classmethod
+    def from_arrays(cls, arrays, cell_size):
+        """
+        Rebuild an index from its arrays and cell size, without copying them
+        """
+
+        index = cls.__new__(cls)
+        for name in cls.ARRAYS:
+            setattr(index, name, arrays[name])
+        index.cell_size = cell_size
+        index.length = float(index.lengths.sum())
+        return index
+
+    def _build(self, chords):
+        if len(chords) == 0:
+            self.origin = np.zeros(3, dtype=np.int64)
+            self.shape = np.ones(3, dtype=np.int64)
+            self.keys = np.empty(0, dtype=np.int64)
+            self.segment_ids = np.empty(0, dtype=np.int64)
+            return
+
+        # Split long segments in pieces no longer than a cell, so that each
+        # piece only spans a couple of cells on each axis
+        pieces = np.maximum(np.ceil(chords / self.cell_size), 1).astype(np.int64)
+        piece_segment = np.repeat(np.arange(len(chords)), pieces)
+        piece_rank = np.arange(len(piece_segment)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+
+        directions = (self.ends - self.starts)[piece_segment]
+        piece_start = self.starts[piece_segment] + directions * (piece_rank / pieces[piece_segment])[:, None]
+        piece_end = self.starts[piece_segment] + directions * ((piece_rank + 1) / pieces[piece_segment])[:, None]
+
+        # The arc bulges out of its chord by at most chord² / 4
+        bulge = (chords ** 2 / 4)[piece_segment, None]
+        low = np.floor((np.minimum(piece_start, piece_end) - bulge) / self.cell_size).astype(np.int64)
+        high = np.floor((np.maximum(piece_start, piece_end) + bulge) / self.cell_size).astype(np.int64)
+
+        # Cells are numbered in the box covering the track, with one cell of
+        # margin so that the neighbours of every track cell are inside it
+        self.origin = low.min(axis=0) - 1
+        self.shape = high.max(axis=0) - self.origin + 2
+
+        # Enumerate every cell of each piece bounding box
+        spans = high - low + 1
+        counts = spans.prod(axis=1)
+        owner = np.repeat(np.arange(len(counts)), counts)
+        rank = np.arange(len(owner)) - np.repeat(np.cumsum(counts) - counts, counts)
+        cells = low[owner] + np.stack((rank % spans[owner, 0],
+                                       rank // spans[owner, 0] % spans[owner, 1],
+                                       rank // (spans[owner, 0] * spans[owner, 1])), axis=1)
+
+        keys = self._keys(cells)
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.segment_ids = piece_segment[owner][order]
+
+    def _keys(self, cells):
+        local = cells - self.origin
+        return (local[..., 0] * self.shape[1] + local[..., 1]) * self.shape[2] + local[..., 2]
+
+    def _cell_ranges(self, points):
+        # Position in segment_ids of the first segment of each of the 27
+        # cells around each point, and their number of segments, by point
+        cells = np.floor(points / self.cell_size).astype(np.int64)
+        neighbours = cells[:, None, :] + NEIGHBOUR_CELLS[None, :, :]
+        local = neighbours - self.origin
+        inside = np.all((local >= 0) & (local < self.shape), axis=2)
+
+        keys = np.where(inside, self._keys(neighbours), -1).ravel()
+        first = np.searchsorted(self.keys, keys, side="left")
+        last = np.searchsorted(self.keys, keys, side="right")
+        return first, np.where(keys >= 0, last - first, 0)
+
+    def candidates(self, points, budget=LOCATE_PAIR_BUDGET):
+        """
+        Yield (point, segment) index pairs of the segments which may be
+        within the radius of each point, grouped by point, by slices of at
+        most budget pairs
+
+        The pairs of a point with many candidates may be split between
+        consecutive slices.
+
+        points: (n, 3) array of unit vectors
+        """
+
+        first, counts = self._cell_ranges(points)
+        ends = np.cumsum(counts)
+        total = int(ends[-1]) if len(ends) else 0
+
+        for start in range(0, total, budget):
+            pairs = np.arange(start, min(start + budget, total))
+            ranges = np.searchsorted(ends, pairs, side="right")
+            segment_ids = self.segment_ids[first[ranges] + pairs - (ends[ranges] - counts[ranges])]
+            yield ranges // len(NEIGHBOUR_CELLS), segment_ids
+
+    def locate(self, points, budget=LOCATE_PAIR_BUDGET):
+        """
+        Return the distance in meter between each point and the track, and
+        the along-track distance in meter of the closest track position
+
+        Beyond the index radius, the distance is only measured to the
+        segments of the neighbour cells: it is beyond the radius too, or
+        infinity with the along-track distance NaN. At most budget candidate
+        (point, segment) pairs are measured at once, which bounds the memory
+        used whatever the radius and the track density.
+
+        points: (n, 3) array of unit vectors
+        """
+
+        distances = np.full(len(points), np.inf)
+        along = np.full(len(points), np.nan)
+        closest = np.full(len(points), -1)
+
+        for point_ids, segment_ids in self.candidates(points, budget):
+            candidates = segment_distance(points[point_ids], self.starts[segment_ids], self.ends[segment_ids])
+
+            # Pairs are grouped by point, keep the first closest segment of each group
+            groups = np.flatnonzero(np.diff(point_ids, prepend=-1))
+            closest_distances = np.minimum.reduceat(candidates, groups)
+            group_ids = np.repeat(np.arange(len(groups)), np.diff(groups, append=len(point_ids)))
+            first = np.flatnonzero(candidates == closest_distances[group_ids])
+            first = first[np.unique(group_ids[first], return_index=True)[1]]
+
+            # Points split between slices keep their first closest segment
+            group_points = point_ids[groups]
+            better = closest_distances < distances[group_points]
+            distances[group_points[better]] = closest_distances[better]
+            closest[group_points[better]] = segment_ids[first[better]]
+
+        # The projection is only needed on the closest segments
+        found = np.flatnonzero(closest >= 0)
+        segment_ids = closest[found]
+        fractions = segment_projection(points[found], self.starts[segment_ids], self.ends[segment_ids])[1]
+        along[found] = self.positions[segment_ids] + fractions * self.lengths[segment_ids]
+        return distances, along
+
+
+def simplify_line(coords, tolerance_m):
+    """
+    Simplify a line with the Douglas-Peucker algorithm
+
+    coords: (n, 2) array of (lat, lon)
+    Return the kept points, so that every dropped point is within
+    tolerance_m of the simplified line.
+    """
+
+    coords = np.asarray(coords, dtype=float)
+    if len(coords) < 3:
+        return coords
+
+    # Local equirectangular projection, in meters
+    scale = np.radians(1) * EARTH_RADIUS
+    x = coords[:, 1] * scale * np.cos(np.radians(coords[:, 0].mean()))
+    y = coords[:, 0] * scale
+
+    keep = np.zeros(len(coords), dtype=bool)
+    keep[[0, -1]] = True
+    # Points whose range may still be split
+    open_points = ~keep
+
+    # Split all the ranges between kept points at once, level by level of
+    # the recursion, until every range fits the tolerance
+    while open_points.any():
+        points = np.flatnonzero(open_points)
+        kept = np.flatnonzero(keep)
+        position = np.searchsorted(kept, points)
+        first, last = kept[position - 1], kept[position]
+
+        chord_x, chord_y = x[last] - x[first], y[last] - y[first]
+        dx, dy = x[points] - x[first], y[points] - y[first]
+        length = chord_x * chord_x + chord_y * chord_y
+        ratio = np.divide(dx * chord_x + dy * chord_y, length, out=np.zeros(len(points)), where=length > 0)
+        ratio = np.clip(ratio, 0, 1)
+        dx -= ratio * chord_x
+        dy -= ratio * chord_y
+        distances = dx * dx + dy * dy
+
+        # Points are grouped by range, find the farthest point of each range
+        starts = np.diff(first, prepend=-1) > 0
+        group = np.cumsum(starts) - 1
+        farthest = np.maximum.reduceat(distances, np.flatnonzero(starts))
+        candidates = np.flatnonzero(distances == farthest[group])
+        _, split = np.unique(group[candidates], return_index=True)
+        split = points[candidates[split]]
+
+        keep[split[farthest > tolerance_m ** 2]] = True
+        open_points[points[farthest[group] <= tolerance_m ** 2]] = False
+        open_points[keep] = False
+
+    return coords[keep]
@@ -0,0 +1,180 @@
+import contextlib
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import rich.table
+
+# Number of allocation sites kept in the tracemalloc snapshot of each stage
+TRACEMALLOC_TOP = 10
+
+# Recorder of the running command, None when instrumentation is disabled
+_active = None
+
+
+class Metrics:
+    """
+    Timings, counters and memory usage of the pipeline stages of a run
+
+    - trace_memory: record the peak traced memory and top allocation sites
+      of each stage with tracemalloc, which slows the run down noticeably
+    - profile_dir: directory where a cProfile dump of each stage is written
+    - profile_stages: names of the stages to profile, all when None
+    """
+
+    def __init__(self, trace_memory=False, profile_dir=None, profile_stages=None):
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.profile_stages = profile_stages
+        self.stages = {}
+        self.counters = {}
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time a pipeline stage, and trace or profile it when enabled
+
+        A stage run several times accumulates its time and keeps its
+        highest memory peak.
+        """
+
+        profiler = None
+        if self.profile_dir is not None and (self.profile_stages is None or name in self.profile_stages):
+            profiler = cProfile.Profile()
+
+        # Nested stages are traced as part of the outermost one
+        tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            seconds = time.perf_counter() - start
+
+            record = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0})
+            record["seconds"] += seconds
+            record["calls"] += 1
+
+            if tracing:
+                _, peak = tracemalloc.get_traced_memory()
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                if peak >= record.get("peak_traced", 0):
+                    record["peak_traced"] = peak
+                    record["top_allocations"] = [
+                        {"location": str(stat.traceback), "size": stat.size, "count": stat.count}
+                        for stat in snapshot.statistics("lineno")[:TRACEMALLOC_TOP]
+                    ]
+
+            record["peak_rss"] = peak_rss()
+
+            if profiler is not None:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                profiler.dump_stats(os.path.join(self.profile_dir, f"{name}.prof"))
+
+    def to_dict(self):
+        return {
+            "total_seconds": time.perf_counter() - self.started,
+            "peak_rss": peak_rss(),
+            "stages": self.stages,
+            "counters": self.counters,
+        }
+
+    def write(self, path):
+        """
+        Write the metrics as JSON to path
+        """
+
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def table(self):
+        """
+        Return the metrics as a rich table
+        """
+
+        table = rich.table.Table(title="Pipeline metrics")
+        table.add_column("Stage")
+        table.add_column("Time", justify="right")
+        table.add_column("Peak RSS", justify="right")
+        if self.trace_memory:
+            table.add_column("Peak traced", justify="right")
+
+        for name, record in self.stages.items():
+            row = [name, f"{record['seconds']:.3f}s", format_size(record.get("peak_rss"))]
+            if self.trace_memory:
+                row.append(format_size(record.get("peak_traced")))
+            table.add_row(*row)
+
+        for name, value in self.counters.items():
+            table.add_row(f"[dim]{name}[/dim]", str(value), "", *([""] if self.trace_memory else []))
+
+        return table
+
+
+def peak_rss():
+    """
+    Return the peak resident memory of the process in bytes, or None if unknown
+    """
+
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kibibytes, macOS bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def format_size(size):
+    if size is None:
+        return "-"
+    return f"{size / 2**20:.1f} MiB"
+
+
+def enable(metrics):
+    """
+    Record the instrumentation of the pipeline to metrics, or disable it when None
+    """
+
+    global _active
+    _active = metrics
+
+
+def stage(name):
+    """
+    Context manager timing a pipeline stage, doing nothing when instrumentation is disabled
+    """
+
+    if _active is None:
+        return contextlib.nullcontext()
+    return _active.stage(name)
+
+
+def count(name, value=1):
+    """
+    Add value to a counter, if instrumentation is enabled
+    """
+
+    if _active is not None:
+        _active.count(name, value)
+
@@ -0,0 +1,119 @@
+import concurrent.futures
+import math
+from multiprocessing import shared_memory
+
+import numpy as np
+import rich.progress
+
+import thirsty.geo
+
+# Alignment of the arrays in shared memory (in bytes)
+ALIGNMENT = 64
+
+# Number of chunks of points per worker process, to balance their load
+CHUNKS_PER_JOB = 4
+
+# Track index and points of the worker process, attached to shared memory
+_worker_state = {}
+
+
+class SharedArrays:
+    """
+    Numpy arrays copied once to a shared memory block, attached by worker processes
+
+    The spec attribute is a small picklable description of the block, given
+    to attach_arrays in the workers instead of the arrays themselves.
+    """
+
+    def __init__(self, arrays):
+        layout, size = {}, 0
+        for name, array in arrays.items():
+            size = -(-size // ALIGNMENT) * ALIGNMENT
+            layout[name] = (size, array.dtype.str, array.shape)
+            size += array.nbytes
+
+        self.memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        try:
+            for name, array in arrays.items():
+                offset, dtype, shape = layout[name]
+                np.ndarray(shape, dtype=dtype, buffer=self.memory.buf, offset=offset)[...] = array
+        except BaseException:
+            self.close()
+            raise
+
+        self.spec = (self.memory.name, layout)
+
+    def close(self):
+        self.memory.close()
+        self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def attach_arrays(spec):
+    """
+    Return the shared memory block of a SharedArrays spec, and its arrays by name, without copying them
+    """
+
+    name, layout = spec
+    memory = shared_memory.SharedMemory(name=name)
+    arrays = {name: np.ndarray(shape, dtype=dtype, buffer=memory.buf, offset=offset)
+              for name, (offset, dtype, shape) in layout.items()}
+    return memory, arrays
+
+
+def _init_worker(spec, cell_size):
+    # The block stays attached for the lifetime of the worker
+    memory, arrays = attach_arrays(spec)
+    _worker_state["memory"] = memory
+    _worker_state["points"] = arrays.pop("points")
+    _worker_state["index"] = thirsty.geo.TrackIndex.from_arrays(arrays, cell_size)
+
+
+def _locate_range(start, stop, batch_size):
+    index, points = _worker_state["index"], _worker_state["points"]
+    distances = np.empty(stop - start)
+    along = np.empty(stop - start)
+
+    for offset in range(0, stop - start, batch_size):
+        end = min(offset + batch_size, stop - start)
+        distances[offset:end], along[offset:end] = index.locate(points[start + offset:start + end])
+
+    return distances, along
+
+
+def locate(index, points, jobs, batch_size, progress=True):
+    """
+    Return TrackIndex.locate of points, measured by jobs worker processes
+
+    The arrays of the index and the points are copied once to shared memory,
+    and the workers are only sent ranges of points, each measured by batches
+    of batch_size points. The results are in the order of the points.
+    """
+
+    count = len(points)
+    chunk_size = max(batch_size, math.ceil(count / (jobs * CHUNKS_PER_JOB)))
+    distances = np.empty(count)
+    along = np.empty(count)
+
+    with SharedArrays({**index.arrays(), "points": points}) as shared, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                                   initargs=(shared.spec, index.cell_size)) as executor:
+        # Workers are started before the progress display thread
+        futures = {executor.submit(_locate_range, start, min(start + chunk_size, count), batch_size): start
+                   for start in range(0, count, chunk_size)}
+
+        with rich.progress.Progress(disable=not progress) as bar:
+            task = bar.add_task("Filtering POI", total=count)
+            for future in concurrent.futures.as_completed(futures):
+                start = futures[future]
+                chunk_distances, chunk_along = future.result()
+                distances[start:start + len(chunk_distances)] = chunk_distances
+                along[start:start + len(chunk_along)] = chunk_along
+                bar.advance(task, len(chunk_distances))
+
+    return distances, along
@@ -0,0 +1,202 @@
+import argparse
+import datetime
+import json
+import os
+import sqlite3
+import threading
+
+import rich.console
+import rich.progress
+
+import thirsty.core
+
+console = rich.console.Console()
+
+# Tag filters of all the POI categories, each stored as one bit of the POI filter mask
+INDEXED_FILTERS = sorted({tag_filter
+                          for _, amenities, _ in thirsty.core.POI_CATEGORIES
+                          for tag_filter in amenities.values()})
+
+# Number of POIs inserted per statement while building a database
+INSERT_BATCH_SIZE = 10000
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE poi (
+    id INTEGER PRIMARY KEY,
+    osm_type TEXT NOT NULL,
+    osm_id INTEGER NOT NULL,
+    lat REAL NOT NULL,
+    lon REAL NOT NULL,
+    filters INTEGER NOT NULL,
+    tags TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE poi_index USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+"""
+
+
+def match_filters(tags, filters=INDEXED_FILTERS):
+    """
+    Return the mask of the tag filters matched by tags, bit i standing for filters[i]
+    """
+
+    mask = 0
+    for i, tag_filter in enumerate(filters):
+        if all(tags.get(key) == value for key, value in thirsty.core.parse_tag_filter(tag_filter)):
+            mask |= 1 << i
+    return mask
+
+
+def build_database(pbf_path, db_path):
+    """
+    Build a POI database from an OSM extract (.osm.pbf, or any format read by osmium)
+
+    Only the nodes matching one of INDEXED_FILTERS are kept, with the tags
+    kept by thirsty.core.compact_element, in an SQLite database with an
+    R*Tree spatial index. The database is
+    written to a temporary file first, and replaces db_path once complete.
+
+    Return the number of POIs stored.
+    """
+
+    # Imported here, as pyosmium is only needed to build databases, not to query them
+    try:
+        import osmium
+        import osmium.filter
+    except ImportError:
+        raise ImportError("building a POI database requires pyosmium, install it with: pip install thirsty[index]") \
+            from None
+
+    # Only let through the nodes with the first tag of a filter, the others are checked here
+    first_tags = sorted({thirsty.core.parse_tag_filter(tag_filter)[0] for tag_filter in INDEXED_FILTERS})
+    nodes = osmium.FileProcessor(pbf_path, osmium.osm.NODE).with_filter(osmium.filter.TagFilter(*first_tags))
+
+    temp_path = db_path + ".tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+    connection = sqlite3.connect(temp_path)
+    try:
+        connection.executescript(SCHEMA)
+
+        count = 0
+        rows = []
+
+        def flush():
+            connection.executemany("INSERT INTO poi VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            connection.executemany("INSERT INTO poi_index VALUES (?, ?, ?, ?, ?)",
+                                   [(row[0], row[3], row[3], row[4], row[4]) for row in rows])
+            rows.clear()
+
+        with rich.progress.Progress(rich.progress.SpinnerColumn(),
+                                    rich.progress.TextColumn("{task.description}: {task.completed} POI")) as progress:
+            task = progress.add_task("Indexing POIs", total=None)
+
+            for node in nodes:
+                if not node.location.valid():
+                    continue
+
+                tags = {tag.k: tag.v for tag in node.tags}
+                mask = match_filters(tags)
+                if not mask:
+                    continue
+
+                count += 1
+                element = thirsty.core.compact_element({"type": "node", "id": node.id, "lat": node.location.lat,
+                                                        "lon": node.location.lon, "tags": tags})
+                rows.append((count, "node", node.id, element["lat"], element["lon"], mask,
+                             json.dumps(element["tags"], ensure_ascii=False, separators=(",", ":"))))
+
+                if len(rows) >= INSERT_BATCH_SIZE:
+                    flush()
+                    progress.update(task, completed=count)
+
+            flush()
+            progress.update(task, completed=count)
+
+        meta = {
+            "source": os.path.abspath(pbf_path),
+            "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "filters": json.dumps(INDEXED_FILTERS),
+            "count": str(count),
+        }
+        connection.executemany("INSERT INTO meta VALUES (?, ?)", meta.items())
+        connection.commit()
+    finally:
+        connection.close()
+
+    os.replace(temp_path, db_path)
+    return count
+
+
+class PoiDatabase:
+    """
+    Local POI database built by build_database, answering the queries of Overpass
+    """
+
+    def __init__(self, path):
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"POI database not found: {path}")
+
+        # Corridor queries run in threads, sharing the read-only connection
+        self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        self._lock = threading.Lock()
+
+        self.path = path
+        self.meta = dict(self.connection.execute("SELECT key, value FROM meta"))
+        self.filters = json.loads(self.meta["filters"])
+
+    def query(self, bbox, tag_filters):
+        """
+        Return the POIs matching any of the tag filters in a (south, west, north, east) bounding box
+
+        POIs are returned as compact Overpass JSON elements, see thirsty.core.compact_element.
+        """
+
+        mask = 0
+        for tag_filter in tag_filters:
+            if tag_filter not in self.filters:
+                raise thirsty.core.OfflineError(f"{tag_filter} is not indexed in {self.path}, rebuild it with "
+                                                "'thirsty index'")
+            mask |= 1 << self.filters.index(tag_filter)
+
+        south, west, north, east = bbox
+
+        # The R*Tree stores rounded coordinates, so matches are checked against the exact ones
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT poi.osm_type, poi.osm_id, poi.lat, poi.lon, poi.tags FROM poi_index "
+                "JOIN poi ON poi.id = poi_index.id "
+                "WHERE poi_index.max_lat >= ? AND poi_index.min_lat <= ? "
+                "AND poi_index.max_lon >= ? AND poi_index.min_lon <= ? "
+                "AND poi.lat BETWEEN ? AND ? AND poi.lon BETWEEN ? AND ? "
+                "AND poi.filters & ? != 0 "
+                "ORDER BY poi.id",
+                (south, north, west, east, south, north, west, east, mask)).fetchall()
+
+        return [{"type": osm_type, "id": osm_id, "lat": lat, "lon": lon, "tags": json.loads(tags)}
+                for osm_type, osm_id, lat, lon, tags in rows]
+
+    def close(self):
+        self.connection.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="thirsty index",
+                                     description="Build a local POI database from an OSM extract, to be used with "
+                                                 "'thirsty --poi-db' instead of querying Overpass.")
+
+    parser.add_argument("input", help="OSM extract (.osm.pbf)")
+
+    parser.add_argument("output", help="POI database to write")
+
+    args = parser.parse_args(argv)
+
+    try:
+        count = build_database(args.input, args.output)
+    except ImportError as e:
+        console.print(f"❌ {e}")
+        return 1
+
+    console.print(f"✅ Indexed {count} POI to {args.output}")
+    return 0
@@ -0,0 +1,284 @@
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import io
+import os
+import shlex
+import threading
+import xml.etree.ElementTree as ET
+
+import requests
+
+try:
+    import aiohttp.web
+except ImportError:
+    aiohttp = None
+
+import thirsty.cache
+import thirsty.cli
+import thirsty.core
+import thirsty.geo
+import thirsty.state
+import thirsty.track
+
+console = thirsty.cli.console
+
+# Default maximum size of the uploaded traces (in MiB)
+DEFAULT_MAX_UPLOAD = 64
+
+# Number of track indexes kept across requests, for traces uploaded again
+INDEX_CACHE_SIZE = 32
+
+# Key of the Annotator in the application
+ANNOTATOR_KEY = aiohttp.web.AppKey("annotator") if aiohttp is not None else None
+
+
+class RequestError(Exception):
+    """
+    Raised on invalid options in a request
+    """
+
+
+class EmptyTrackError(Exception):
+    """
+    Raised on an uploaded trace without track points
+    """
+
+
+class _OptionParser(argparse.ArgumentParser):
+    # Report option errors to the client instead of exiting
+    def error(self, message):
+        raise RequestError(message)
+
+
+def make_option_parser():
+    """
+    Return the parser of the options of a request, the POI options of the CLI
+    """
+
+    parser = _OptionParser(prog="thirsty", add_help=False)
+    thirsty.cli.add_poi_arguments(parser)
+    parser.add_argument("--corridor", action="store_true")
+    return parser
+
+
+def _read_track(data):
+    # Run in a worker process, the document is kept by the server
+    track = thirsty.track.read_track(io.BytesIO(data))
+    track.source = None
+    return track
+
+
+def _render(track, data, pois, args):
+    # Run in a worker process
+    if args.html or args.html_fast:
+        map = thirsty.core.display_gpx_on_map(track, pois, fast=args.html_fast, tolerance_m=args.html_tolerance)
+        return map.get_root().render(), "text/html"
+
+    track.source = io.BytesIO(data)
+    return thirsty.cli.render_gpx(track, pois, km=args.km), "application/gpx+xml"
+
+
+class Annotator:
+    """
+    Annotation pipeline of the server, keeping its state warm across requests
+
+    The Overpass responses are cached in memory, in front of the optional
+    disk cache, the track indexes of the latest traces are kept for traces
+    uploaded again, and the HTTP connections to Overpass are kept alive by
+    the shared session of thirsty.core. Reading the traces and rendering
+    the results is pure Python, which holds the GIL: it runs in a pool of
+    jobs processes. The filtering runs in numpy, which releases it, and
+    needs the cached track indexes: it runs in a pool of jobs threads. The
+    event loop keeps serving requests meanwhile.
+    """
+
+    def __init__(self, args, cache=None, poi_db=None):
+        self.args = args
+        self.cache = thirsty.cache.MemoryCache(cache, max_entries=args.memory_cache_entries, ttl=args.cache_ttl)
+        self.poi_db = poi_db
+        self.parser = make_option_parser()
+        self.jobs = concurrent.futures.ThreadPoolExecutor(max_workers=max(args.jobs, 1),
+                                                          thread_name_prefix="thirsty-job")
+        self.processes = concurrent.futures.ProcessPoolExecutor(max_workers=max(args.jobs, 1))
+        self._indexes = collections.OrderedDict()
+        self._indexes_lock = threading.Lock()
+
+    def parse_options(self, options):
+        """
+        Return the arguments of a request, its options on top of the server arguments
+        """
+
+        try:
+            words = shlex.split(options)
+        except ValueError as e:
+            raise RequestError(e) from e
+
+        request_args = self.parser.parse_args(words)
+        if request_args.ways and self.poi_db is not None:
+            raise RequestError("--ways is not supported with --poi-db")
+        return argparse.Namespace(**{**vars(self.args), **vars(request_args)})
+
+    def get_index(self, track, radius_m):
+        """
+        Return the TrackIndex of a track, reusing the one of a previous request on the same trace
+        """
+
+        key = (thirsty.state.track_digest(track.segments), radius_m)
+
+        with self._indexes_lock:
+            index = self._indexes.get(key)
+            if index is not None:
+                self._indexes.move_to_end(key)
+                return index
+
+        index = thirsty.geo.TrackIndex(track.segments, radius_m)
+
+        with self._indexes_lock:
+            self._indexes[key] = index
+            while len(self._indexes) > INDEX_CACHE_SIZE:
+                self._indexes.popitem(last=False)
+        return index
+
+    def filter_pois(self, track, pois, args, type_distances):
+        """
+        Return the POIs near the track
+        """
+
+        index = self.get_index(track, max([args.distance, *type_distances.values()]))
+        return thirsty.core.filter_pois_near_track(track, pois, max_distance_m=args.distance,
+                                                   type_distances=type_distances, progress=False, index=index)
+
+    async def annotate(self, data, options=""):
+        """
+        Return the annotated GPX document, or HTML map, of an uploaded trace, and its content type
+        """
+
+        args = self.parse_options(options)
+        poi_types = thirsty.cli.get_poi_types(args, verbose=False)
+        type_distances = thirsty.cli.get_type_distances(args)
+
+        loop = asyncio.get_running_loop()
+        track = await loop.run_in_executor(self.processes, _read_track, data)
+        if len(track) == 0:
+            raise EmptyTrackError("No track point in the GPX trace")
+
+        # Waiting for Overpass does not hold a job
+        pois = await loop.run_in_executor(None, functools.partial(thirsty.cli.query_pois, track, args, poi_types,
+                                                                  type_distances, cache=self.cache,
+                                                                  poi_db=self.poi_db, progress=False))
+
+        pois = await loop.run_in_executor(self.jobs, self.filter_pois, track, pois, args, type_distances)
+        return await loop.run_in_executor(self.processes, _render, track, data, pois, args)
+
+    def close(self):
+        self.jobs.shutdown(wait=False, cancel_futures=True)
+        self.processes.shutdown(wait=False, cancel_futures=True)
+        if self.poi_db is not None:
+            self.poi_db.close()
+
+
+async def handle_annotate(request):
+    """
+    Annotate a GPX trace, uploaded as the request body or as the gpx field of a form
+
+    POI options are given as in the CLI, in the options query parameter or
+    form field, e.g. "-w water -t --km". The annotated GPX document is
+    returned, or the HTML map with --html or --html-fast.
+    """
+
+    annotator = request.app[ANNOTATOR_KEY]
+    options = request.query.get("options", "")
+
+    if request.content_type.startswith("multipart/"):
+        data = None
+        async for part in await request.multipart():
+            if part.name == "options":
+                options = await part.text()
+            elif part.name == "gpx":
+                data = await part.read()
+    else:
+        data = await request.read()
+
+    if not data:
+        raise aiohttp.web.HTTPBadRequest(text="No GPX trace uploaded\n")
+
+    try:
+        body, content_type = await annotator.annotate(data, options)
+    except RequestError as e:
+        raise aiohttp.web.HTTPBadRequest(text=f"Invalid options: {e}\n") from e
+    except (ET.ParseError, EmptyTrackError) as e:
+        raise aiohttp.web.HTTPBadRequest(text=f"Invalid GPX trace: {e}\n") from e
+    except thirsty.core.OfflineError as e:
+        raise aiohttp.web.HTTPServiceUnavailable(text=f"{e}\n") from e
+    except (requests.RequestException, thirsty.core.OverpassError) as e:
+        raise aiohttp.web.HTTPBadGateway(text=f"Overpass query failed: {e}\n") from e
+
+    return aiohttp.web.Response(text=body, content_type=content_type)
+
+
+async def handle_health(request):
+    return aiohttp.web.json_response({"status": "ok"})
+
+
+def make_app(annotator, max_upload=DEFAULT_MAX_UPLOAD):
+    """
+    Return the aiohttp application serving an Annotator
+    """
+
+    app = aiohttp.web.Application(client_max_size=int(max_upload * 2**20))
+    app[ANNOTATOR_KEY] = annotator
+    app.router.add_post("/annotate", handle_annotate)
+    app.router.add_get("/health", handle_health)
+
+    async def close(app):
+        annotator.close()
+
+    app.on_cleanup.append(close)
+    return app
+
+
+def make_parser():
+    """
+    Return the parser of the arguments of the server
+    """
+
+    parser = argparse.ArgumentParser(prog="thirsty serve",
+                                     description="Serve the annotation of GPX traces over HTTP, keeping caches and "
+                                                 "connections warm across requests.")
+
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address to listen on (default: 127.0.0.1)")
+
+    parser.add_argument("--port", type=int, default=8080,
+                        help="port to listen on (default: 8080)")
+
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="number of traces read, filtered and rendered at once, in as many processes and "
+                             "threads")
+
+    parser.add_argument("--max-upload", type=float, default=DEFAULT_MAX_UPLOAD,
+                        help=f"maximum size of the uploaded traces (in MiB, default: {DEFAULT_MAX_UPLOAD})")
+
+    parser.add_argument("--memory-cache-entries", type=int, default=thirsty.cache.DEFAULT_MEMORY_ENTRIES,
+                        help="number of Overpass responses kept in memory, in front of --cache-dir "
+                             f"(default: {thirsty.cache.DEFAULT_MEMORY_ENTRIES})")
+
+    thirsty.cli.add_overpass_arguments(parser)
+    return parser
+
+
+def main(argv=None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+
+    if aiohttp is None:
+        console.print("❌ The server requires aiohttp, install it with: pip install thirsty[serve]")
+        return 1
+
+    annotator = Annotator(args, cache=thirsty.cli.get_cache(parser, args), poi_db=thirsty.cli.get_poi_db(parser, args))
+
+    aiohttp.web.run_app(make_app(annotator, max_upload=args.max_upload), host=args.host, port=args.port)
+    return 0
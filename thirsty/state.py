@@ -0,0 +1,138 @@
+import gzip
+import hashlib
+import json
+import time
+
+import numpy as np
+import rich.console
+
+import thirsty.cache
+import thirsty.core
+
+console = rich.console.Console()
+
+# Version of the state file format, states of other versions are ignored
+STATE_VERSION = 1
+
+
+def track_digest(segments):
+    """
+    Return a digest of the coordinates of track segments
+    """
+
+    digest = hashlib.sha256()
+    for coords in segments:
+        digest.update(np.ascontiguousarray(coords, dtype=float).tobytes())
+        digest.update(b"|")
+    return digest.hexdigest()
+
+
+class State:
+    """
+    Results of a run by corridor tile, reused by the next runs on an edited trace
+
+    - settings: options all the results depend on, the tiles are discarded
+      when they change
+    - tiles: by "row,column" tile key, a dict with the Overpass query of the
+      tile ("query"), when it was run ("time") and its elements ("elements"),
+      and the key of the filtering ("filter": track segments and distances)
+      with the [type, id] of the elements kept near the track ("pois")
+    """
+
+    def __init__(self, settings, tiles=None):
+        self.settings = settings
+        self.tiles = tiles or {}
+
+    @classmethod
+    def load(cls, path, settings):
+        """
+        Return the state saved to path, or an empty one if missing, unreadable or saved with other settings
+        """
+
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return cls(settings)
+        except (OSError, EOFError, ValueError):
+            console.print(f"⚠️  Cannot read state {path}, starting over")
+            return cls(settings)
+
+        if data.get("version") != STATE_VERSION or data.get("settings") != settings:
+            console.print(f"⚠️  State {path} was saved with other settings, starting over")
+            return cls(settings)
+
+        return cls(settings, data["tiles"])
+
+    def save(self, path):
+        """
+        Write the state to path, replacing it atomically
+        """
+
+        thirsty.cache.write_json(path, {"version": STATE_VERSION, "settings": self.settings, "tiles": self.tiles},
+                                 compress=True)
+
+
+def annotate_tiles(state, tiles, queries, fetch, filter_pois, filter_key="", ttl=None):
+    """
+    Return the POIs near the corridor tiles, reusing the results of the unchanged tiles of a state
+
+    Each tile is filtered against its own segments only: as its bounding box
+    covers them with the largest search distance, the union of the results
+    of all the tiles is the same as filtering all the elements against the
+    whole track.
+
+    - state: State of the previous run, replaced by the tiles of this run
+    - tiles: (key, bbox, segments) tuples of get_corridor_tiles
+    - queries: Overpass query of each tile, its elements are fetched again
+      when it changed or is older than ttl seconds
+    - fetch: function returning the lists of elements of a list of bounding boxes
+    - filter_pois: function returning the Pois of a list of elements near a list of segments
+    - filter_key: search distances, a tile is filtered again when they or
+      its segments changed
+
+    Return the POIs, and the number of tiles fetched, filtered, and reused.
+    """
+
+    now = time.time()
+    results = {}
+    stale = []
+
+    for (key, _, segments), query in zip(tiles, queries):
+        name = f"{key[0]},{key[1]}"
+        previous = state.tiles.get(name)
+        if previous is None or previous["query"] != query or (ttl is not None and now - previous["time"] > ttl):
+            previous = {"query": query, "time": now, "elements": None}
+            stale.append(name)
+        results[name] = dict(previous, filter=filter_key + track_digest(segments))
+        if previous.get("filter") != results[name]["filter"]:
+            results[name]["pois"] = None
+
+    bboxes = {f"{key[0]},{key[1]}": bbox for key, bbox, _ in tiles}
+    for name, elements in zip(stale, fetch([bboxes[name] for name in stale])):
+        results[name]["elements"] = elements
+
+    filtered = 0
+    pois = []
+    for key, _, segments in tiles:
+        tile = results[f"{key[0]},{key[1]}"]
+        if tile["pois"] is None:
+            filtered += 1
+            kept = filter_pois(tile["elements"], segments)
+            tile["pois"] = [[poi.osm_type, poi.id] for poi in kept]
+        else:
+            keys = {(osm_type, osm_id) for osm_type, osm_id in tile["pois"]}
+            kept = thirsty.core.classify_pois(element for element in tile["elements"]
+                                              if (element.get("type", "node"), element.get("id")) in keys)
+        pois.extend(kept)
+
+    state.tiles = results
+
+    # POIs near several tiles are only kept once
+    unique, seen = [], set()
+    for poi in pois:
+        if (poi.osm_type, poi.id) not in seen:
+            seen.add((poi.osm_type, poi.id))
+            unique.append(poi)
+
+    return unique, len(stale), filtered, len(tiles) - filtered
@@ -0,0 +1,139 @@
+import array
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+
+class Track:
+    """
+    Coordinates of the track points of a GPX trace, stored in flat arrays
+
+    - lat, lon: point coordinates in degrees
+    - offsets: index of the first point of each track segment, followed by
+      the total number of points
+    - source: seekable file object of the original GPX document, if any
+    """
+
+    def __init__(self, lat, lon, offsets, source=None):
+        self.lat = np.asarray(lat, dtype=float)
+        self.lon = np.asarray(lon, dtype=float)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.source = source
+
+    def __len__(self):
+        return len(self.lat)
+
+    @property
+    def segments(self):
+        """
+        Track segments as (n, 2) arrays of (lat, lon)
+        """
+
+        return [np.stack((self.lat[start:stop], self.lon[start:stop]), axis=1)
+                for start, stop in zip(self.offsets[:-1], self.offsets[1:])]
+
+    @classmethod
+    def from_gpx(cls, gpx):
+        """
+        Build a Track from a gpxpy GPX object
+        """
+
+        lat, lon, offsets = array.array("d"), array.array("d"), [0]
+        for trk in gpx.tracks:
+            for seg in trk.segments:
+                for pt in seg.points:
+                    lat.append(pt.latitude)
+                    lon.append(pt.longitude)
+                offsets.append(len(lat))
+
+        return cls(np.frombuffer(lat), np.frombuffer(lon), offsets)
+
+    @classmethod
+    def from_segments(cls, segments):
+        """
+        Build a Track from segments as (n, 2) arrays of (lat, lon)
+        """
+
+        segments = [np.asarray(coords, dtype=float).reshape(-1, 2) for coords in segments]
+        points = np.concatenate(segments) if segments else np.empty((0, 2))
+        offsets = np.concatenate(([0], np.cumsum([len(coords) for coords in segments], dtype=np.int64)))
+
+        return cls(points[:, 0], points[:, 1], offsets)
+
+
+def concatenate(tracks):
+    """
+    Return a Track with the segments of all the given tracks
+    """
+
+    tracks = list(tracks)
+    lat = np.concatenate([track.lat for track in tracks]) if tracks else np.empty(0)
+    lon = np.concatenate([track.lon for track in tracks]) if tracks else np.empty(0)
+
+    offsets, total = [0], 0
+    for track in tracks:
+        offsets.extend(total + track.offsets[1:])
+        total += len(track)
+
+    return Track(lat, lon, offsets)
+
+
+def as_track(data):
+    """
+    Return data as a Track, converting gpxpy GPX objects
+    """
+
+    if isinstance(data, Track):
+        return data
+    return Track.from_gpx(data)
+
+
+def _local_name(tag):
+    return tag.rpartition("}")[2]
+
+
+def read_track(source):
+    """
+    Read the track points of a GPX document in a single streaming pass
+
+    Elements are dropped as soon as they are parsed, so that memory only
+    grows with the coordinate arrays. The source is kept in the returned
+    Track, and rewound, so that the document can be read again for output.
+    Invalid documents, and track points without valid coordinates, raise
+    xml.etree.ElementTree.ParseError.
+    """
+
+    lat, lon, offsets = array.array("d"), array.array("d"), [0]
+    segment = None
+
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        name = _local_name(elem.tag)
+
+        if event == "start":
+            if name == "trkseg":
+                segment = elem
+            continue
+
+        if name == "trkpt":
+            if segment is None:
+                continue
+            try:
+                point = float(elem.get("lat")), float(elem.get("lon"))
+            except (TypeError, ValueError) as e:
+                raise ET.ParseError(f"invalid track point coordinates: lat={elem.get('lat')!r} "
+                                    f"lon={elem.get('lon')!r}") from e
+            lat.append(point[0])
+            lon.append(point[1])
+            # Drop the parsed points from their segment
+            del segment[:]
+        elif name == "trkseg":
+            offsets.append(len(lat))
+            elem.clear()
+            segment = None
+        elif name in ("trk", "rte", "wpt"):
+            elem.clear()
+
+    if hasattr(source, "seek"):
+        source.seek(0)
+
+    return Track(np.frombuffer(lat), np.frombuffer(lon), offsets, source=source)
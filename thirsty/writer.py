@@ -0,0 +1,375 @@
+import contextlib
+import io
+import mmap
+import re
+import xml.etree.ElementTree as ET
+
+import thirsty.core
+
+# Number of characters buffered before being written to the output
+WRITE_BUFFER_SIZE = 1 << 16
+
+# Same lookups of the namespaces and schema locations as gpxpy, done on the raw document
+_NAMESPACE = re.compile(rb'\sxmlns:?[^=]*="[^"]+"')
+_DEFAULT_NAMESPACE = re.compile(rb"""\sxmlns=(['"])([^'"]+)\1""")
+_SCHEMA_LOCATION = re.compile(rb'\sxsi:schemaLocation="[^"]+"')
+
+# Top-level elements, and track fields following a track segment, to check the schema order
+_ORDER = re.compile(rb"<(metadata|wpt|rte|trk)[\s/>]|</trkseg>\s*<(?!trkseg[\s/>]|/trk>)")
+
+# Rank of the top-level elements in the schema order
+_RANKS = {b"metadata": 0, b"wpt": 1, b"rte": 2, b"trk": 3}
+
+# Indentation of gpxpy for the elements written one by one
+_TOP_INDENT = "  "
+_SEGMENT_INDENT = "    "
+_POINT_INDENT = "      "
+
+
+def _open_buffer(source):
+    # Map files instead of reading them, so that scanning them does not take memory
+    if isinstance(source, io.BytesIO):
+        return source.getbuffer()
+    try:
+        return mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        data = source.read()
+        source.seek(0)
+        return data
+
+
+def scan_document(source):
+    """
+    Return the namespaces, schema locations and default namespace of a GPX document, as gpxpy reads them
+
+    Also return whether its elements are in the order of the GPX schema:
+    metadata, waypoints, routes and tracks, with the track fields before
+    their segments.
+    """
+
+    data = _open_buffer(source)
+    try:
+        nsmap = {}
+        for match in _NAMESPACE.finditer(data):
+            prefix, _, uri = match.group()[6:].decode().partition("=")
+            prefix = prefix.lstrip(":") or "defaultns"
+            nsmap[prefix] = uri.strip('"')
+
+        schema_locations = []
+        match = _SCHEMA_LOCATION.search(data)
+        if match:
+            schema_locations = match.group().decode().partition("=")[2].strip('"').split()
+
+        match = _DEFAULT_NAMESPACE.search(data)
+        default_namespace = match.group(2).decode() if match else None
+
+        ordered, rank = True, 0
+        for match in _ORDER.finditer(data):
+            if match.group(1) is None or _RANKS[match.group(1)] < rank:
+                ordered = False
+                break
+            rank = _RANKS[match.group(1)]
+    finally:
+        if isinstance(data, memoryview):
+            data.release()
+        elif isinstance(data, mmap.mmap):
+            data.close()
+
+    return nsmap, schema_locations, default_namespace, ordered
+
+
+class _Output:
+    """
+    Buffered output, sanitizing the chunks written as sanitize_gpx_text would the whole document
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self.parts = []
+        self.size = 0
+        self.written = 0
+
+    def write(self, text):
+        # Entities never span chunks, as these are whole elements
+        if "&" in text:
+            text = thirsty.core.sanitize_gpx_text(text)
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= WRITE_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        data = "".join(self.parts)
+        self.output.write(data)
+        self.written += len(data)
+        self.parts.clear()
+        self.size = 0
+
+
+class _Serializer:
+    """
+    gpxpy (de)serialization of single elements of a document
+    """
+
+    def __init__(self, nsmap, schema_locations, default_namespace):
+        import gpxpy.gpx
+        import gpxpy.gpxfield
+        import gpxpy.utils
+
+        self.gpx = gpxpy.gpx
+        self.fields = gpxpy.gpxfield
+        self.make_str = gpxpy.utils.make_str
+
+        # gpxpy drops the default namespace before parsing
+        self.prefix = f"{{{default_namespace}}}" if default_namespace else ""
+        self.nsmap = dict(nsmap)
+        self.schema_locations = schema_locations
+        self.version = None
+        self.output_version = None
+
+        self.trkpt_tag = self.prefix + "trkpt"
+        self.ele_tag = self.prefix + "ele"
+        self.time_tag = self.prefix + "time"
+
+    def name(self, tag):
+        """
+        Return a tag as seen by gpxpy, without the default namespace
+        """
+
+        if self.prefix and tag.startswith(self.prefix):
+            return tag[len(self.prefix):]
+        return tag
+
+    def strip(self, element):
+        """
+        Remove the default namespace from the tags of an element and its children
+        """
+
+        if self.prefix:
+            for child in element.iter():
+                child.tag = self.name(child.tag)
+        return element
+
+    def parse(self, cls, element):
+        return self.fields.gpx_fields_from_xml(cls, self.strip(element), self.version)
+
+    def to_xml(self, cls, name, objects, indent):
+        """
+        Serialize objects as the name list field of cls does
+        """
+
+        fields = cls.gpx_11_fields if self.output_version == "1.1" else cls.gpx_10_fields
+        for field in fields:
+            if not isinstance(field, str) and field.name == name:
+                return field.to_xml(objects, self.output_version, self.nsmap, prettyprint=True, indent=indent)
+
+        # Not written in this version, as extensions in GPX 1.0
+        return ""
+
+    def header(self, root):
+        """
+        Return the XML declaration and gpx start tag, followed by the metadata of a document root
+        """
+
+        head = ET.Element(root.tag, root.attrib)
+        head.extend(child for child in root if self.name(child.tag) not in ("wpt", "rte", "trk", "extensions"))
+
+        gpx = self.parse(self.gpx.GPX, head)
+        gpx.nsmap = self.nsmap
+        if self.schema_locations:
+            gpx.schema_locations = list(self.schema_locations)
+        text = gpx.to_xml()
+
+        # to_xml() completes the namespaces, and sets the output version
+        self.nsmap = gpx.nsmap
+        self.output_version = gpx.version
+        return text[:-len("\n</gpx>")]
+
+    def track(self, element):
+        """
+        Return the XML of a track without its segments, and its closing tag
+        """
+
+        head = ET.Element(element.tag, element.attrib)
+        head.extend(child for child in element if self.name(child.tag) != "trkseg")
+        text = self.to_xml(self.gpx.GPX, "tracks", [self.parse(self.gpx.GPXTrack, head)], _TOP_INDENT)
+        end = f"\n{_TOP_INDENT}</trk>"
+        return text[:-len(end)], end
+
+    def track_point(self, element):
+        """
+        Return the XML of a track point, formatted directly for the common points with elevation and time only
+        """
+
+        lat, lon = element.get("lat"), element.get("lon")
+        ele = time = None
+
+        if lat is not None and lon is not None and len(element) <= 2:
+            for child in element:
+                if child.tag == self.ele_tag and ele is None:
+                    ele = child
+                elif child.tag == self.time_tag and time is None:
+                    time = child
+                else:
+                    break
+            else:
+                # Invalid values are reported by gpxpy
+                with contextlib.suppress(ValueError):
+                    return self._simple_track_point(lat, lon, ele, time)
+
+        point = self.parse(self.gpx.GPXTrackPoint, element)
+        return self.to_xml(self.gpx.GPXTrackSegment, "points", [point], _POINT_INDENT)
+
+    def _simple_track_point(self, lat, lon, ele, time):
+        # Same conversions as the gpxpy fields, with str() standing for make_str() without exponent
+        lat, lon = str(float(lat.strip())), str(float(lon.strip()))
+        if "e" in lat or "e" in lon:
+            lat, lon = self.make_str(float(lat)), self.make_str(float(lon))
+        text = f'\n{_POINT_INDENT}<trkpt lat="{lat}" lon="{lon}">'
+
+        if ele is not None and ele.text is not None:
+            value = str(float(ele.text.strip()))
+            if "e" in value:
+                value = self.make_str(float(value))
+            text += f"\n{_POINT_INDENT}  <ele>{value}</ele>"
+
+        if time is not None:
+            value = self.fields.TIME_TYPE.from_string(time.text)
+            if value is not None:
+                text += f"\n{_POINT_INDENT}  <time>{self.fields.format_time(value)}</time>"
+
+        return text + f"\n{_POINT_INDENT}</trkpt>"
+
+
+def write_gpx(source, output, pois=(), km=False):
+    """
+    Write a GPX document with POIs added as waypoints, streaming its tracks
+
+    The output is the same as parsing the document with gpxpy, adding the
+    POIs with thirsty.core.add_waypoints_to_gpx and writing
+    sanitize_gpx_text(gpx.to_xml()), but only one waypoint, route or track
+    point is parsed at once, and the output is written as it goes. Common
+    track points, with elevation and time only, are formatted directly.
+    Documents not in the order of the GPX schema are handled by gpxpy.
+
+    - source: seekable binary file object of the GPX document
+    - output: text file object to write to
+    - km: see thirsty.core.add_waypoints_to_gpx
+
+    Return the number of characters written.
+    """
+
+    source.seek(0)
+    nsmap, schema_locations, default_namespace, ordered = scan_document(source)
+
+    if not ordered:
+        return _write_gpxpy(source, output, pois, km=km)
+
+    import gpxpy.gpx
+
+    out = _Output(output)
+    serializer = _Serializer(nsmap, schema_locations, default_namespace)
+    root = track = segment = extensions = None
+    header_written = pois_written = False
+    track_end = None
+    segment_start = f"\n{_SEGMENT_INDENT}<trkseg>"
+    depth = 0
+
+    source.seek(0)
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if depth > 3:
+                continue
+
+            if depth == 1:
+                root = elem
+                serializer.version = root.get("version")
+                continue
+
+            name = serializer.name(elem.tag)
+            if depth == 2:
+                if name in ("wpt", "rte", "trk") and not header_written:
+                    out.write(serializer.header(root))
+                    header_written = True
+                if name in ("rte", "trk") and not pois_written:
+                    waypoints = thirsty.core.add_waypoints_to_gpx(gpxpy.gpx.GPX(), pois, km=km).waypoints
+                    out.write(serializer.to_xml(gpxpy.gpx.GPX, "waypoints", waypoints, _TOP_INDENT))
+                    pois_written = True
+                if name == "trk":
+                    track, track_end = elem, None
+            elif track is not None and name == "trkseg":
+                # Track fields come before the segments
+                if track_end is None:
+                    text, track_end = serializer.track(track)
+                    out.write(text)
+                segment = elem
+                out.write(segment_start)
+            continue
+
+        depth -= 1
+
+        if depth == 3:
+            if segment is not None and elem.tag == serializer.trkpt_tag:
+                out.write(serializer.track_point(elem))
+                segment.remove(elem)
+            continue
+
+        if depth > 3:
+            continue
+
+        name = serializer.name(elem.tag)
+
+        if depth == 2:
+            if segment is not None and name == "trkseg":
+                # Segment extensions, the points were written already
+                segments = [serializer.parse(gpxpy.gpx.GPXTrackSegment, segment)]
+                out.write(serializer.to_xml(gpxpy.gpx.GPXTrack, "segments", segments, _SEGMENT_INDENT)
+                          [len(segment_start):])
+                track.remove(segment)
+                segment = None
+            continue
+
+        if depth == 1:
+            if name == "wpt":
+                waypoints = [serializer.parse(gpxpy.gpx.GPXWaypoint, elem)]
+                out.write(serializer.to_xml(gpxpy.gpx.GPX, "waypoints", waypoints, _TOP_INDENT))
+            elif name == "rte":
+                routes = [serializer.parse(gpxpy.gpx.GPXRoute, elem)]
+                out.write(serializer.to_xml(gpxpy.gpx.GPX, "routes", routes, _TOP_INDENT))
+            elif name == "trk":
+                out.write(track_end or "".join(serializer.track(elem)))
+                track = None
+            elif name == "extensions" and extensions is None:
+                # Only the first extensions are kept by gpxpy, and written last
+                extensions = [serializer.strip(child) for child in elem]
+                continue
+            else:
+                continue
+            root.remove(elem)
+            continue
+
+        # End of the document
+        if not header_written:
+            out.write(serializer.header(root))
+        if not pois_written:
+            waypoints = thirsty.core.add_waypoints_to_gpx(gpxpy.gpx.GPX(), pois, km=km).waypoints
+            out.write(serializer.to_xml(gpxpy.gpx.GPX, "waypoints", waypoints, _TOP_INDENT))
+        if extensions:
+            out.write(serializer.to_xml(gpxpy.gpx.GPX, "extensions", extensions, _TOP_INDENT))
+        out.write("\n</gpx>")
+
+    out.flush()
+    source.seek(0)
+    return out.written
+
+
+def _write_gpxpy(source, output, pois=(), km=False):
+    # Whole document parsed and serialized by gpxpy
+    import gpxpy
+
+    gpx = thirsty.core.add_waypoints_to_gpx(gpxpy.parse(source), pois, km=km)
+    data = thirsty.core.sanitize_gpx_text(gpx.to_xml())
+    output.write(data)
+    source.seek(0)
+    return len(data)